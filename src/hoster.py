@@ -1,38 +1,281 @@
-from urllib.parse import unquote
-from threading import Thread
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Iterator
+from threading import Thread, Lock
+from time import sleep, monotonic
+import subprocess
 import importlib
+import signal
+import asyncio
+import select
 import traceback
+import codecs
+import struct
+from stat import S_ISDIR, S_ISREG
 import os.path
 import socket
 import sys
 
+try:
+    # Only used to ask Linux how much of a response hasn't been read yet
+    from termios import TIOCOUTQ as SIOCOUTQ
+    from fcntl import ioctl
+except ImportError:
+    SIOCOUTQ = ioctl = None
+
+from libraries.worker_pool import WorkerPool
+from libraries.idle_watcher import IdleWatcher
+from libraries.http_parser import RequestParser, Request, BadRequest
+from libraries.ranges import parse_range
+from libraries.lru_cache import LRUCache
+from libraries.ignore import IgnoreRules
+from libraries.content_cache import ContentCache
+from libraries.mmap_pool import MmapPool
+from libraries.buffer import MemoryFile, BufferPool
+from libraries.prefork import Supervisor
+from libraries.rate_limit import RateLimiter, Pacer
+from libraries import content_encoding
 from libraries import website_pages
 
 socket.Socket = socket.socket
 
 
 GUI = False
+# In dev mode `website_pages` is reloaded when its file changes (or when the
+# process gets a SIGHUP) so the pages can be edited without a restart
+DEV_MODE = True
+# "threads" starts a thread per connection, "pool" hands the connections to
+# `POOL_THREADS` reusable threads through a queue of `POOL_QUEUE_SIZE`
+# connections, "asyncio" multiplexes all of the connections on one event
+# loop and does the disk reads in `EXECUTOR_WORKERS` threads. In the pool,
+# connections that are waiting for a request don't hold a thread, 1 thread
+# watches all of them and queues the ones that the client sent something on.
+ENGINE = "threads"
+ENGINES = ("threads", "pool", "asyncio")
+EXECUTOR_WORKERS = 16
+POOL_THREADS = 32
+POOL_QUEUE_SIZE = 64
+POOL_STACK_SIZE = 512*1024
+# How long (in seconds) an idle connection is kept open waiting for the next
+# request and how many requests can be sent over the same connection
+KEEP_ALIVE_TIMEOUT = 15
+MAX_KEEP_ALIVE_REQUESTS = 100
+# The number of processes (each running `ENGINE`) that serve the port. 0
+# means 1 per CPU. With `WORKER_AFFINITY`, each one is pinned to its own CPU.
+# With `REUSE_PORT` each process has its own socket (`SO_REUSEPORT`) so the
+# kernel spreads the connections evenly, otherwise they share 1 socket. Only
+# Linux balances `SO_REUSEPORT` sockets (BSD/macOS give all of the
+# connections to 1 of them) so it's off everywhere else.
+WORKERS = 1
+WORKER_AFFINITY = False
+REUSE_PORT = sys.platform.startswith("linux") and \
+             hasattr(socket, "SO_REUSEPORT")
+# `kill -USR1 <pid>` writes the stats (of all of the workers added up) to
+# stderr
+STATS_SIGNAL = "SIGUSR1"
+# Connections over the limit (from 1 IP address/in total) are answered with
+# "429 Too Many Requests"/"503 Service Unavailable" (and "Retry-After") as
+# soon as they are accepted. `None` means no limit.
+MAX_CONNECTIONS = 1024
+MAX_CONNECTIONS_PER_IP = 16
+RETRY_AFTER = 5
+# A request has to arrive within `HEADER_TIMEOUT` seconds of the connection
+# opening (or of its first byte arriving on a kept alive connection)
+HEADER_TIMEOUT = 10
+# Sending gives up if the client doesn't read anything for `SEND_TIMEOUT`
+# seconds or if it reads slower than `MIN_SEND_RATE` bytes per second (after
+# `MIN_RATE_GRACE` seconds spent sending to it). `None` means no minimum.
+# The rate is checked while each piece (see `SEND_PIECE_SIZE`) is sent so
+# a slow client can't hold on to one for long.
+SEND_TIMEOUT = 30
+MIN_SEND_RATE = 1024*4
+MIN_RATE_GRACE = 10
+# Responses are sent in pieces of at most `SEND_PIECE_SIZE` bytes so the
+# limits above can be checked while a big file is being sent
+SEND_PIECE_SIZE = 1024*256
+# How long a drain (SIGTERM, or SIGUSR2 which first starts a new process
+# that takes over the socket) waits for the responses being sent to finish
+DRAIN_TIMEOUT = 30
+RECV_SIZE = 1024*4
+# The folder listings are cached until the folder changes. Changing a file
+# inside it doesn't change the folder so after `LISTING_TTL` seconds the
+# folder is read again to see if the sizes/mtimes in the listing changed.
+LISTING_TTL = 2
+LISTING_CACHE_ENTRIES = 256
+LISTING_CACHE_BYTES = 1024*1024*64
+# Bigger listings are streamed (with "Transfer-Encoding: chunked") instead
+# of being rendered and cached
+MAX_CACHED_LISTING_ENTRIES = 2000
+# Compress text responses if the client accepts "gzip"/"deflate" (or "zstd"
+# if the `zstandard` module is installed). Files up to
+# `MAX_CACHED_VARIANT_SIZE` are compressed once and cached, bigger ones are
+# compressed while they are sent.
+COMPRESSION = True
+MIN_COMPRESS_SIZE = 1024
+MAX_CACHED_VARIANT_SIZE = 1024*1024*8
+VARIANT_CACHE_ENTRIES = 1024
+VARIANT_CACHE_BYTES = 1024*1024*64
+# If "<file>.zst"/"<file>.gz" exists and is newer than "<file>", it's sent
+# instead of "<file>" to clients that accept it (best first)
+PRECOMPRESSED = {"zstd": ".zst", "gzip": ".gz"}
+# How many bytes are read to guess if a file with an unknown extension is
+# text. The guess is remembered for `SNIFF_CACHE_ENTRIES` files.
+SNIFF_SIZE = 1024*8
+SNIFF_CACHE_ENTRIES = 4096
+# Files up to `MAX_CACHED_FILE_SIZE` are kept in memory (`CONTENT_CACHE_BYTES`
+# in total) if they are asked for often enough
+CONTENT_CACHE_BYTES = 1024*1024*64
+MAX_CACHED_FILE_SIZE = 1024*256
 
 
 ERROR_RAISED = False
 CHUNK_SIZE = 1024*1024*10
+# Send files with `sendfile` so the data doesn't go through python. If the
+# platform doesn't have it, files are mapped into memory instead (up to
+# `MMAP_POOL_BYTES` in total) and each mapping is shared by all of the
+# connections sending that file.
+USE_SENDFILE = hasattr(os, "sendfile")
+MMAP_POOL_BYTES = 1024*1024*1024*2
+# Files that can't be mapped are read into reused buffers that are about as
+# big as the socket's send buffer. All of them together use at most
+# `SEND_BUFFERS_BYTES`. Files that are compressed on the fly are read into
+# them too, `MAX_SEND_BUFFER` bytes at a time.
+SEND_BUFFERS_BYTES = 1024*1024*64
+MIN_SEND_BUFFER = 1024*16
+MAX_SEND_BUFFER = 1024*1024
+# Bandwidth limits in bytes per second (`None` means unlimited) for each
+# connection, each IP address and for everyone together (in each process).
+# The limit for each connection is left to the kernel (`SO_MAX_PACING_RATE`)
+# when it can do it, the rest are enforced by sending the data in pieces of
+# `PACING_CHUNK_SIZE` bytes and waiting between them.
+RATE_LIMIT_CONNECTION = None
+RATE_LIMIT_IP = None
+RATE_LIMIT_TOTAL = None
+PACING_CHUNK_SIZE = 1024*64
+
+
+class FileSlice:
+    """
+    Yielded by the request handlers instead of `bytes` when `count` bytes
+    starting at `offset` in `file` should be sent. The engines pass it to
+    `sendfile` so the kernel copies the data straight into the socket.
+    """
+    __slots__ = ("file", "offset", "count")
+
+    def __init__(self, file, offset:int, count:int):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+
+class SlowClient(TimeoutError):
+    """
+    Raised while sending a response to a client that reads it slower than
+    `MIN_SEND_RATE`.
+    """
+
+
+class FileTruncated(Exception):
+    """
+    Raised when a file got shorter while it was being sent. The
+    "Content-Length" that was already sent is wrong so the connection has
+    to be closed (the next response would end up inside this one's body).
+    """
+
+
+class Session:
+    """
+    What `handle_connection` remembers about a connection between requests
+    so the pool engine can let go of the connection while it's idle.
+    """
+    __slots__ = ("parser", "requests", "pacer", "deadline")
+
+    def __init__(self, pacer:Pacer, deadline:float=None):
+        # Keeps everything we received but haven't handled yet. Pipelined
+        # requests stay in there until we finish sending the previous response.
+        self.parser = RequestParser()
+        self.requests = 0
+        self.pacer = pacer
+        # When the request that the connection is waiting for has to arrive
+        self.deadline = deadline
 
 
 class FTPServer:
-    __slots__ = ("port", "ip", "socket", "running")
+    __slots__ = ("port", "ip", "socket", "running", "engine", "loop",
+                 "executor", "buffer_released", "server_task", "pool", "idle",
+                 "reuse_port", "pages_mtime", "reload_lock",
+                 "listings", "ignore", "variants", "content_cache",
+                 "mmap_pool", "sniffed", "buffers", "draining",
+                 "connections", "connections_lock", "limiter",
+                 "ip_connections", "rejections", "rejected", "timeouts",
+                 "aborted")
 
-    def __init__(self, port:int=80):
+    def __init__(self, port:int=80, engine:str=ENGINE,
+                 listener:socket.Socket=None, reuse_port:bool=False):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine: {engine!r}")
         self.port = port
+        self.engine = engine
         self.running = True
+        self.draining = False
+        self.socket = None
+        # If the socket is our own `SO_REUSEPORT` socket (the other
+        # processes serving the port have their own ones)
+        self.reuse_port = reuse_port and (listener is None)
+        # {connection: [busy, ip]} where busy is `False` while it's waiting
+        # for its next request
+        self.connections = {}
+        # {ip: number of connections}
+        self.ip_connections = {}
+        self.connections_lock = Lock()
+        # Built once so turning connections away is cheap
+        too_many = website_pages.try_again_later
+        self.rejections = {"ip": too_many("429 Too Many Requests", RETRY_AFTER),
+                           "total": too_many("503 Service Unavailable",
+                                             RETRY_AFTER)}
+        self.rejected = {"ip": 0, "total": 0}
+        # The connections closed for being too slow
+        self.timeouts = {"header": 0, "send": 0, "slow": 0}
+        # The responses that weren't fully sent because the client left
+        self.aborted = 0
+        self.loop = None
+        # The asyncio engine's (bounded) executor for the blocking disk work
+        self.executor = None
+        # Set (in the asyncio engine) when a buffer goes back to `buffers`
+        self.buffer_released = None
+        self.server_task = None
+        self.pool = None
+        self.idle = None
+        self.pages_mtime = self.get_pages_mtime()
+        self.reload_lock = Lock()
+        # {folder: ((mtime, inode, ...), expires, etag, files, response)}
+        self.listings = LRUCache(max_entries=LISTING_CACHE_ENTRIES,
+                                 max_bytes=LISTING_CACHE_BYTES)
+        self.ignore = IgnoreRules(".ignore")
+        # {(path, encoding): (validator, compressed)}
+        self.variants = LRUCache(max_entries=VARIANT_CACHE_ENTRIES,
+                                 max_bytes=VARIANT_CACHE_BYTES)
+        self.content_cache = ContentCache(max_bytes=CONTENT_CACHE_BYTES)
+        self.mmap_pool = MmapPool(max_bytes=MMAP_POOL_BYTES)
+        # {(device, inode, mtime, size): is_text}
+        self.sniffed = LRUCache(max_entries=SNIFF_CACHE_ENTRIES)
+        self.buffers = BufferPool(max_bytes=SEND_BUFFERS_BYTES,
+                                  min_size=MIN_SEND_BUFFER,
+                                  max_size=MAX_SEND_BUFFER)
+        self.limiter = RateLimiter(per_connection=RATE_LIMIT_CONNECTION,
+                                   per_ip=RATE_LIMIT_IP,
+                                   total=RATE_LIMIT_TOTAL)
         self.ip = socket.gethostbyname(socket.gethostname())
 
         sys.stderr.write(f"IP address = {self.ip}\n")
         sys.stderr.write(f"port = {self.port}\n")
+        sys.stderr.write(f"engine = {self.engine}\n")
 
-        self.socket = socket.Socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind(("0.0.0.0", self.port))
-        self.socket.listen()
+        # `listener` is a socket that is already listening (from the
+        # process that started us)
+        if listener is None:
+            listener = make_listener(self.port, reuse_port=reuse_port)
+        self.socket = listener
 
     def send_exception(self, connection:socket.Socket, error:Exception) -> None:
         _traceback = traceback.format_exc()
@@ -42,152 +285,1390 @@ class FTPServer:
         self.stop()
 
     def start_server(self) -> None:
-        new_thread = Thread(target=self._start_server, daemon=True)
+        if self.engine == "asyncio":
+            target = self._start_async_server
+        else:
+            target = self._start_server
+        if self.engine == "pool":
+            self.pool = WorkerPool(self.handle_connection,
+                                   threads=POOL_THREADS,
+                                   queue_size=POOL_QUEUE_SIZE,
+                                   thread_stack_size=POOL_STACK_SIZE)
+            self.pool.start()
+            # Blocks while the pool's queue is full, so the rest of the
+            # connections wait
+            self.idle = IdleWatcher(on_ready=self.pool.put,
+                                    on_timeout=self.idle_timeout)
+            self.idle.start()
+        new_thread = Thread(target=target, daemon=True)
         new_thread.start()
 
     def _start_server(self) -> None:
-        while self.running:
+        while self.running and (not self.draining):
             try:
+                # Wakes up every now and then to see if `drain` was called
+                readable, _, _ = select.select([self.socket], [], [], 0.5)
+                if len(readable) == 0:
+                    continue
                 connection, address = self.socket.accept()
-                new_thread = Thread(target=self.handle_connection,
-                                    daemon=True, args=(connection, ))
-                new_thread.start()
-            except OSError:
+                self.dispatch(connection, address)
+            except (OSError, ValueError):
+                # The socket was closed by `stop`
                 self.running = False
+        if self.running and self.reuse_port:
+            for connection, address in self.accept_backlog():
+                self.dispatch(connection, address)
+
+    def dispatch(self, connection:socket.Socket, address:tuple) -> None:
+        # Gives a connection that was just accepted to the engine
+        if not self.admit(connection, address[0]):
+            return None
+        if self.idle is not None:
+            # A worker only gets it once the request starts arriving
+            session = self.open_session(connection)
+            session.deadline = monotonic() + HEADER_TIMEOUT
+            self.idle.watch(connection, session, session.deadline)
+            return None
+        new_thread = Thread(target=self.handle_connection, daemon=True,
+                            args=(connection, ))
+        new_thread.start()
+
+    def accept_backlog(self) -> Iterator[tuple[socket.Socket, tuple]]:
+        # Accepts the connections that are already waiting (without waiting
+        # for new ones) and then closes the socket. When draining, our own
+        # `SO_REUSEPORT` socket is closed straight away so the kernel sends
+        # the new connections to the other processes' sockets instead of
+        # queueing them where no one will accept them.
+        self.socket.setblocking(False)
+        while True:
+            try:
+                yield self.socket.accept()
+            except OSError:
+                break
+        self.socket.close()
 
-    def handle_connection(self, connection:socket.Socket) -> None:
+    def _start_async_server(self) -> None:
+        try:
+            asyncio.run(self._async_server())
+        except asyncio.CancelledError:
+            pass
+
+    async def _async_server(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.server_task = asyncio.current_task()
+        self.socket.setblocking(False)
+        # Only the disk reads/`os.listdir`s go to the executor so it can
+        # be much smaller than the number of open connections
+        executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
+        self.executor = executor
+        self.buffer_released = released = asyncio.Event()
+        loop = self.loop
+        self.buffers.on_release = lambda: loop.call_soon_threadsafe(released.set)
+        try:
+            while self.running:
+                try:
+                    connection, address = await self.loop.sock_accept(self.socket)
+                except OSError:
+                    self.running = False
+                    break
+                except asyncio.CancelledError:
+                    if not self.draining:
+                        raise
+                    break
+                if not self.admit(connection, address[0]):
+                    continue
+                self.loop.create_task(self.async_handle_connection(connection,
+                                                                   executor))
+            if self.running and self.reuse_port:
+                for connection, address in self.accept_backlog():
+                    if self.admit(connection, address[0]):
+                        handler = self.async_handle_connection(connection,
+                                                               executor)
+                        self.loop.create_task(handler)
+            # Keep the event loop running until `drain` calls `stop`
+            while self.running:
+                await asyncio.sleep(0.1)
+        finally:
+            self.buffers.on_release = None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def parse_request(self, request:Request) -> str:
+        # Returns the requested filename
+        if request.method not in ("GET", "HEAD"):
+            raise BadRequest("405 Method Not Allowed")
+        filename = request.path
+        if len(filename) == 0:
+            filename = "."
+        return filename
+
+    def keep_alive(self, request:Request) -> bool:
+        # HTTP/1.1 connections are persistent unless the client says
+        # otherwise, HTTP/1.0 ones only if the client asks for it
+        connection = request.headers.get("connection", "").lower()
+        connection = tuple(token.strip() for token in connection.split(","))
+        if "close" in connection:
+            return False
+        if request.version == "HTTP/1.0":
+            return "keep-alive" in connection
+        return True
+
+    def admit(self, connection:socket.Socket, ip:str) -> bool:
+        # Starts tracking a connection that was just accepted. If there are
+        # too many connections, it's turned away (and closed) instead.
+        with self.connections_lock:
+            if (MAX_CONNECTIONS is not None) and \
+               (len(self.connections) >= MAX_CONNECTIONS):
+                reason = "total"
+            elif (MAX_CONNECTIONS_PER_IP is not None) and \
+                 (self.ip_connections.get(ip, 0) >= MAX_CONNECTIONS_PER_IP):
+                reason = "ip"
+            else:
+                self.connections[connection] = [True, ip]
+                self.ip_connections[ip] = self.ip_connections.get(ip, 0) + 1
+                return True
+            self.rejected[reason] += 1
+        try:
+            # Don't wait for a client that isn't reading
+            connection.setblocking(False)
+            connection.send(self.rejections[reason])
+            connection.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        connection.close()
+        return False
+
+    def track(self, connection:socket.Socket, busy:bool) -> None:
+        with self.connections_lock:
+            if connection in self.connections:
+                self.connections[connection][0] = busy
+
+    def untrack(self, connection:socket.Socket) -> None:
+        with self.connections_lock:
+            if connection not in self.connections:
+                return None
+            busy, ip = self.connections.pop(connection)
+            self.ip_connections[ip] -= 1
+            if self.ip_connections[ip] == 0:
+                del self.ip_connections[ip]
+
+    def close_idle(self) -> None:
+        # Wakes up the connections waiting for their next request (`recv`
+        # returns b"") so they close
+        # Under the lock so none of them can start a request in between
+        with self.connections_lock:
+            for connection, (busy, ip) in self.connections.items():
+                if busy:
+                    continue
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def drain(self, timeout:float=DRAIN_TIMEOUT) -> bool:
+        """
+        Stops accepting connections and waits (at most `timeout` seconds)
+        for the responses that are being sent to finish before stopping.
+        Returns `False` if some of them didn't finish in time.
+        """
+        sys.stderr.write("Draining the server.\n")
+        self.draining = True
+        # A shared socket stays open (for a process that took it over) until
+        # `stop`, our own `SO_REUSEPORT` one is closed by the accepting loop
+        if self.server_task is not None:
+            self.loop.call_soon_threadsafe(self.server_task.cancel)
+        deadline = monotonic() + timeout
+        while (len(self.connections) > 0) and (monotonic() < deadline):
+            self.close_idle()
+            sleep(0.1)
+        finished = len(self.connections) == 0
+        self.stop()
+        return finished
+
+    def handle_connection(self, connection:socket.Socket,
+                          session:Session=None) -> None:
+        # `session` is given when the pool engine hands back a connection
+        # that was idle (its client has sent something since)
+        resumed = session is not None
+        if session is None:
+            session = self.open_session(connection)
         connection_id = str(id(connection))[-5:]
-        request = connection.recv(1024).decode()
-        importlib.reload(website_pages)
+        parser = session.parser
+        # "header" while receiving a request, "idle" while waiting for the
+        # next one and "send" while sending the response
+        stage = "header"
+        try:
+            while session.requests < MAX_KEEP_ALIVE_REQUESTS:
+                request = parser.next_request()
+                if (request is None) and (session.requests > 0):
+                    self.track(connection, busy=False)
+                    stage = "header" if len(parser.buffer) > 0 else "idle"
+                    if (stage == "idle") and (not resumed) and \
+                       (self.idle is not None):
+                        # Let the worker go until the next request arrives
+                        session.deadline = self.receive_deadline(stage)
+                        self.idle.watch(connection, session, session.deadline)
+                        session = None
+                        return None
+                if resumed:
+                    deadline = session.deadline
+                    resumed = False
+                else:
+                    deadline = self.receive_deadline(stage)
+                while request is None:
+                    connection.settimeout(self.time_left(deadline))
+                    data = connection.recv(RECV_SIZE)
+                    if len(data) == 0:
+                        return None
+                    if stage == "idle":
+                        # The next request started arriving
+                        stage = "header"
+                        deadline = self.receive_deadline(stage)
+                    parser.feed(data)
+                    request = parser.next_request()
+                self.track(connection, busy=True)
+                stage = "send"
+                connection.settimeout(SEND_TIMEOUT)
+
+                filename = self.parse_request(request)
+
+                if session.requests == 0:
+                    sys.stderr.write(f"[Debug]: Connection({connection_id}) opened.\n")
+                session.requests += 1
+                keep_alive = self.keep_alive(request) and \
+                             (session.requests < MAX_KEEP_ALIVE_REQUESTS) and \
+                             (not self.draining)
 
-        if ("GET " not in request) or (" HTTP" not in request):
+                responses = self.respond(filename, request, keep_alive)
+                try:
+                    for data in responses:
+                        if not self.sendall(connection, data, session.pacer):
+                            # The client left, stop reading the file
+                            self.count_aborted()
+                            return None
+                finally:
+                    responses.close()
+
+                if not keep_alive:
+                    break
+        except BadRequest as error:
+            self.sendall(connection, website_pages.bad_request(error.status))
+        except SlowClient:
+            self.count_timeout("slow")
+            self.reset(connection)
+        except FileTruncated as error:
+            print(f"[WARNING]: \t{error}")
+        except TimeoutError:
+            if stage != "idle":
+                self.count_timeout(stage)
+            if stage == "send":
+                self.reset(connection)
+        except ConnectionError:
+            return None
+        finally:
+            # Close the connection (unless it's waiting in `self.idle`):
+            if session is not None:
+                self.close_session(connection, session)
+
+    def open_session(self, connection:socket.Socket) -> Session:
+        return Session(self.limiter.open(connection))
+
+    def close_session(self, connection:socket.Socket, session:Session) -> None:
+        if session.requests > 0:
+            connection_id = str(id(connection))[-5:]
+            print(f"[Debug]: \t\tConnection({connection_id}) closed.")
+        self.limiter.close(session.pacer)
+        self.untrack(connection)
+        connection.close()
+
+    def idle_timeout(self, connection:socket.Socket, session:Session) -> None:
+        # Called by `self.idle` when the client didn't send anything in time
+        if (session.requests == 0) or (len(session.parser.buffer) > 0):
+            self.count_timeout("header")
+        self.close_session(connection, session)
+
+    async def async_handle_connection(self, connection:socket.Socket,
+                                      executor:ThreadPoolExecutor) -> None:
+        connection_id = str(id(connection))[-5:]
+        connection.setblocking(False)
+        parser = RequestParser()
+        requests = 0
+        pacer = self.limiter.open(connection)
+        # "header" while receiving a request, "idle" while waiting for the
+        # next one and "send" while sending the response
+        stage = "header"
+        try:
+            while requests < MAX_KEEP_ALIVE_REQUESTS:
+                request = parser.next_request()
+                if (request is None) and (requests > 0):
+                    self.track(connection, busy=False)
+                    stage = "header" if len(parser.buffer) > 0 else "idle"
+                deadline = self.receive_deadline(stage)
+                while request is None:
+                    data = await asyncio.wait_for(self.loop.sock_recv(connection,
+                                                                      RECV_SIZE),
+                                                  self.time_left(deadline))
+                    if len(data) == 0:
+                        return None
+                    if stage == "idle":
+                        # The next request started arriving
+                        stage = "header"
+                        deadline = self.receive_deadline(stage)
+                    parser.feed(data)
+                    request = parser.next_request()
+                self.track(connection, busy=True)
+                stage = "send"
+
+                filename = self.parse_request(request)
+
+                if requests == 0:
+                    sys.stderr.write(f"[Debug]: Connection({connection_id}) opened.\n")
+                requests += 1
+                keep_alive = self.keep_alive(request) and \
+                             (requests < MAX_KEEP_ALIVE_REQUESTS) and \
+                             (not self.draining)
+
+                # `respond` is the same generator that `handle_connection`
+                # uses so each step (that might block on the disk) is run
+                # inside the executor and only the sending is done on the
+                # event loop
+                responses = self.respond(filename, request, keep_alive)
+                try:
+                    while True:
+                        data = await self.loop.run_in_executor(executor, next,
+                                                               responses, None)
+                        if data is None:
+                            break
+                        if not await self.async_sendall(connection, data,
+                                                        pacer):
+                            # The client left, stop reading the file
+                            self.count_aborted()
+                            return None
+                finally:
+                    responses.close()
+
+                if not keep_alive:
+                    break
+        except BadRequest as error:
+            await self.async_sendall(connection,
+                                     website_pages.bad_request(error.status))
+        except SlowClient:
+            self.count_timeout("slow")
+            self.reset(connection)
+        except FileTruncated as error:
+            print(f"[WARNING]: \t{error}")
+        except TimeoutError:
+            if stage != "idle":
+                self.count_timeout(stage)
+            if stage == "send":
+                self.reset(connection)
+        except ConnectionError:
+            return None
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if requests > 0:
+                print(f"[Debug]: \t\tConnection({connection_id}) closed.")
+            self.limiter.close(pacer)
+            self.untrack(connection)
             connection.close()
+
+    def receive_deadline(self, stage:str) -> float:
+        if stage == "idle":
+            return monotonic() + KEEP_ALIVE_TIMEOUT
+        return monotonic() + HEADER_TIMEOUT
+
+    def time_left(self, deadline:float) -> float:
+        timeout = deadline - monotonic()
+        if timeout <= 0:
+            raise TimeoutError("The request took too long to arrive.")
+        return timeout
+
+    def count_timeout(self, reason:str) -> None:
+        with self.connections_lock:
+            self.timeouts[reason] += 1
+
+    def count_aborted(self) -> None:
+        with self.connections_lock:
+            self.aborted += 1
+
+    def reset(self, connection:socket.Socket) -> None:
+        # Makes `close` send a RST so the data that is still in the kernel's
+        # buffers is thrown away instead of trickling out to a client that
+        # is too slow (or stopped reading)
+        try:
+            connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                  struct.pack("ii", 1, 0))
+        except OSError:
+            pass
+
+    def respond(self, filename:str, request:Request,
+                keep_alive:bool=True) -> Iterator[bytes|FileSlice]:
+        responses = self.route(filename, request)
+        try:
+            # The first thing that `route` yields always has the headers
+            headers = next(responses)
+            if not keep_alive:
+                headers = website_pages.close_connection(headers)
+            if request.method == "HEAD":
+                yield website_pages.head_only(headers)
+                return None
+            yield headers
+            yield from responses
+        finally:
+            responses.close()
+
+    def get_pages_mtime(self) -> int:
+        try:
+            return os.stat(website_pages.__file__).st_mtime_ns
+        except OSError:
             return None
 
-        sys.stderr.write(f"[Debug]: Connection({connection_id}) opened.\n")
+    def reload_pages(self) -> None:
+        # Reloads `website_pages` only if its file changed since the last time
+        if not DEV_MODE:
+            return None
+        mtime = self.get_pages_mtime()
+        if mtime == self.pages_mtime:
+            return None
+        with self.reload_lock:
+            if mtime == self.pages_mtime:
+                return None
+            sys.stderr.write("[Debug]: Reloading website_pages.\n")
+            importlib.reload(website_pages)
+            self.pages_mtime = mtime
 
-        filename = request[request.index("GET ")+5:request.index(" HTTP")]
-        filename = unquote(filename) # "%20" => " "
+    def request_reload(self) -> None:
+        # Makes the next request reload `website_pages`
+        self.pages_mtime = None
 
-        if len(filename) == 0:
-            filename = "."
+    def route(self, filename:str,
+              request:Request) -> Iterator[bytes|FileSlice]:
+        self.reload_pages()
+        self.ignore.reload()
         print(f"[Debug]: \t\tAsked for \"{filename}\"")
 
         # Make sure we don't leak any files:
         if (".." in filename) or (":" in filename):
             print("[WARNING]: \tSomeone tried to leak files.")
-            self.sendall(connection, website_pages.get_404(filename))
+            yield website_pages.get_404(filename)
+
+        # Files in ".ignore" act like they don't exist
+        elif self.is_ignored(filename):
+            print("[Debug]: \t\tSending 404 (ignored)")
+            yield website_pages.get_404(filename)
 
         # Send "favicon.ico", don't have a good icon right now
         elif filename == "favicon.ico":
-            self.sendall(connection, website_pages.get_favicon())
+            yield website_pages.get_favicon()
 
-        # If the file exists:
-        elif os.path.exists(filename):
-            if os.path.isdir(filename):
-                self.send_folder(connection, filename)
+        # If the file exists (this is the only `stat` for the request):
+        elif (stat := self.stat(filename)) is not None:
+            if S_ISDIR(stat.st_mode):
+                yield from self.send_folder(filename, request, stat)
             else:
-                self.send_file(connection, filename)
+                yield from self.send_file(filename, request, stat)
 
         # Unknown file
         else:
             print("[Debug]: \t\tSending 404")
-            self.sendall(connection, website_pages.get_404(filename))
+            yield website_pages.get_404(filename)
 
-        # Close the connection:
-        print(f"[Debug]: \t\tConnection({connection_id}) closed.")
-        connection.close()
+    def stat(self, filename:str) -> os.stat_result:
+        # Returns `None` if the file doesn't exist
+        try:
+            return os.stat(filename)
+        except (OSError, ValueError):
+            return None
 
-    def send_file(self, connection:socket.Socket, filename:str) -> None:
+    def send_file(self, filename:str, request:Request,
+                  stat:os.stat_result) -> Iterator[bytes|FileSlice]:
         # Get the file's extenstion
         extension = filename.split(".")[-1]
         if "/" in extension.replace("\\", "/"):
             extension = ""
 
-        # Read the file and get the filesize:
-        size = os.path.getsize(filename)
-        file = open(filename, "rb")
-        data = file.read(CHUNK_SIZE)
+        size = stat.st_size
+        # The extension that decides the "Content-Type"
+        cache_control = website_pages.cache_control(extension)
+        extension = self.content_extension(extension, filename, stat)
+        mimetype = website_pages.EXTENSION_MIMETYPE[extension]
+
+        # "If-Range" means: only send the range if the file didn't change
+        range_header = request.headers.get("range", None)
+        if (range_header is not None) and \
+           (not self.if_range_matches(request, stat)):
+            range_header = None
+
+        # Compressed files are always sent whole
+        sidecar = encoding = None
+        if range_header is None:
+            sidecar = self.find_precompressed(filename, request, stat,
+                                              mimetype)
+            if sidecar is not None:
+                encoding = sidecar[1]
+            else:
+                encoding = self.get_encoding(request, mimetype, size)
+
+        # Checked before the file is opened (or read into `content_cache`)
+        if sidecar is not None:
+            etag = self.make_etag(stat, encoding, sidecar[2])
+        else:
+            etag = self.make_etag(stat, encoding)
+        headers = website_pages.validators(etag, stat.st_mtime,
+                                           cache_control,
+                                           self.varies(mimetype))
+        if self.not_modified(request, etag, stat):
+            yield website_pages.not_modified(headers)
+            return None
+
+        # If there is a precompressed version of the file, send that
+        if sidecar is not None:
+            yield from self.send_precompressed(extension, *sidecar,
+                                               headers=headers)
+            return None
+
+        # Open the file:
+        with self.open_file(filename, stat) as file:
+            if encoding is not None:
+                yield from self.send_compressed(file, filename, extension,
+                                                stat, encoding, headers)
+                return None
+
+            ranges = parse_range(range_header, size)
+
+            # Send the whole file
+            if ranges is None:
+                yield website_pages.file_header(extension, size,
+                                                headers=headers)
+                yield from self.send_from_buffer(file, 0, size)
+
+            # None of the ranges are inside the file
+            elif len(ranges) == 0:
+                yield website_pages.range_not_satisfiable(size)
+
+            # Send only the part that was asked for (the browser seeking)
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                yield website_pages.partial_content(extension, start, end, size,
+                                                    headers=headers)
+                yield from self.send_from_buffer(file, start, end-start+1)
 
-        # Check if we should send it as bytes or as plain text
+            else:
+                response, parts = website_pages.multipart_byteranges(extension,
+                                                                     ranges,
+                                                                     size,
+                                                                     headers)
+                yield response
+                for part, (start, end) in zip(parts, ranges):
+                    yield part
+                    yield from self.send_from_buffer(file, start, end-start+1)
+                yield parts[-1]
+
+    def content_extension(self, extension:str, filename:str,
+                          stat:os.stat_result) -> str:
+        # Files with a known extension are sent with its mimetype. The rest
+        # are sent as text ("txt") if their first `SNIFF_SIZE` bytes look
+        # like text and as bytes ("ts") otherwise.
+        extension = extension.lower()
+        if extension == "htm":
+            return "html"
+        if extension in website_pages.EXTENSION_MIMETYPE:
+            return extension
+        key = (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        is_text = self.sniffed.get(key)
+        if is_text is None:
+            with open(filename, "rb") as file:
+                is_text = self.is_text(file.read(SNIFF_SIZE))
+            self.sniffed.set(key, is_text)
+        return "txt" if is_text else "ts"
+
+    def is_text(self, data:bytes) -> bool:
+        if b"\x00" in data:
+            return False
+        # `data` can end in the middle of a character
+        decoder = codecs.getincrementaldecoder("utf-8")()
         try:
-            data.decode()
-            send_as_bytes = False
+            decoder.decode(data, final=False)
+            return True
         except UnicodeDecodeError:
-            send_as_bytes = True
+            return False
+
+    def open_file(self, filename:str, stat:os.stat_result) -> MemoryFile:
+        # Small files come from (and go into) `content_cache`, everything
+        # else is opened normally
+        if stat.st_size > MAX_CACHED_FILE_SIZE:
+            return open(filename, "rb")
+        key = (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        data = self.content_cache.get(key)
+        if data is None:
+            with open(filename, "rb") as file:
+                data = file.read()
+            # Don't cache it if it changed since the `stat`
+            if len(data) == stat.st_size:
+                self.content_cache.put(key, data)
+        return MemoryFile(data)
+
+    def make_etag(self, stat:os.stat_result, encoding:str=None,
+                  sidecar:os.stat_result=None) -> str:
+        # Changes when the file changes. Each encoding is a different file
+        # for the browser so it needs a different ETag. A precompressed
+        # `sidecar` has different bytes than the file compressed by us and
+        # can be regenerated on its own, so its ETag has the sidecar's
+        # mtime/size too.
+        etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+        if sidecar is not None:
+            etag += f"-{sidecar.st_mtime_ns:x}-{sidecar.st_size:x}"
+        if encoding is not None:
+            etag += "-" + encoding
+        return f"\"{etag}\""
+
+    def not_modified(self, request:Request, etag:str,
+                     stat:os.stat_result=None) -> bool:
+        # Checks "If-None-Match" and "If-Modified-Since"
+        if_none_match = request.headers.get("if-none-match", None)
+        if if_none_match is not None:
+            if if_none_match.strip() == "*":
+                return True
+            etags = (tag.strip().removeprefix("W/")
+                     for tag in if_none_match.split(","))
+            return etag in etags
+        if_modified_since = request.headers.get("if-modified-since", None)
+        if (if_modified_since is not None) and (stat is not None):
+            since = self.parse_http_date(if_modified_since)
+            return (since is not None) and (int(stat.st_mtime) <= since)
+        return False
 
-        # If it's a htm/html file
-        if (extension in ("html", "htm")) and (not send_as_bytes):
-            data += file.read()
-            file.close()
-            data = data.decode()
-            self.sendall(connection, website_pages.raw_html(data))
+    def if_range_matches(self, request:Request, stat:os.stat_result) -> bool:
+        if_range = request.headers.get("if-range", None)
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        # Weak ETags never match
+        if if_range.startswith("W/"):
+            return False
+        if if_range.startswith("\""):
+            return if_range == self.make_etag(stat)
+        return self.parse_http_date(if_range) == int(stat.st_mtime)
+
+    def parse_http_date(self, date:str) -> int:
+        # Returns `None` if the date is invalid
+        try:
+            return int(parsedate_to_datetime(date).timestamp())
+        except (TypeError, ValueError, IndexError):
             return None
 
-        # Send the headers + first chunk
-        if not send_as_bytes:
-            self.sendall(connection, website_pages.txt(data, size))
-        elif extension == "mp4":
-            self.sendall(connection, website_pages.response_from_mp4(data, size))
-        else:
-            self.sendall(connection, website_pages.response_from_mp2t(data, size))
+    def get_encoding(self, request:Request, mimetype:str,
+                     size:int=None) -> str:
+        # Returns the "Content-Encoding" to use or `None` if the response
+        # shouldn't be compressed
+        if not COMPRESSION:
+            return None
+        if not content_encoding.is_compressible(mimetype):
+            return None
+        if size is not None:
+            if size < MIN_COMPRESS_SIZE:
+                return None
+            # Big files are compressed while streaming them with
+            # "Transfer-Encoding: chunked" which HTTP/1.0 doesn't have
+            if (size > MAX_CACHED_VARIANT_SIZE) and \
+               (request.version == "HTTP/1.0"):
+                return None
+        return content_encoding.negotiate(request.headers.get("accept-encoding"))
+
+    def varies(self, mimetype:str) -> bool:
+        # If the response can depend on the "Accept-Encoding" header (even
+        # when it isn't compressed, caches have to know that)
+        if (not COMPRESSION) and (not PRECOMPRESSED):
+            return False
+        return content_encoding.is_compressible(mimetype)
 
-        # Send the rest of the data
-        self.send_from_buffer(connection, file)
+    def find_precompressed(self, filename:str, request:Request,
+                           stat:os.stat_result,
+                           mimetype:str) -> tuple[str, str, os.stat_result]:
+        # Looks for "<filename>.zst"/"<filename>.gz" that is newer than the
+        # file and that the client accepts. Returns `(path, encoding, stat)`
+        # or `None`. Files that aren't worth compressing (videos, images...)
+        # can't have one so that doesn't cost them any `stat`s.
+        if not PRECOMPRESSED:
+            return None
+        if not content_encoding.is_compressible(mimetype):
+            return None
+        accept_encoding = request.headers.get("accept-encoding")
+        for encoding in content_encoding.acceptable(accept_encoding,
+                                                    tuple(PRECOMPRESSED)):
+            path = filename + PRECOMPRESSED[encoding]
+            sidecar = self.stat(path)
+            if (sidecar is None) or (not S_ISREG(sidecar.st_mode)):
+                continue
+            if sidecar.st_mtime_ns < stat.st_mtime_ns:
+                # Out of date
+                continue
+            return path, encoding, sidecar
+        return None
+
+    def send_precompressed(self, extension:str, path:str, encoding:str,
+                           stat:os.stat_result,
+                           headers:dict=None) -> Iterator[bytes|FileSlice]:
+        print(f"[Debug]: \t\tSending \"{path}\" ({encoding}) instead.")
+        with open(path, "rb") as file:
+            yield website_pages.file_header(extension, stat.st_size, encoding,
+                                            headers)
+            yield from self.send_from_buffer(file, 0, stat.st_size)
+
+    def send_compressed(self, file, filename:str, extension:str,
+                        stat:os.stat_result, encoding:str,
+                        headers:dict=None) -> Iterator[bytes]:
+        # The compressed files are cached until the file changes
+        key = (filename, encoding)
+        validator = (stat.st_mtime_ns, stat.st_size)
+        cached = self.variants.get(key)
+        if (cached is not None) and (cached[0] == validator):
+            data = cached[1]
+        elif stat.st_size > MAX_CACHED_VARIANT_SIZE:
+            yield from website_pages.chunked(extension, self.read_chunks(file),
+                                             encoding=encoding, headers=headers)
+            return None
+        else:
+            compressor = content_encoding.Compressor(encoding)
+            data = [compressor.compress(chunk)
+                    for chunk in self.read_chunks(file)]
+            data = b"".join(data) + compressor.finish()
+            self.variants.set(key, (validator, data), size=len(data))
+        yield website_pages.file_header(extension, len(data), encoding, headers)
+        yield data
 
-    def send_from_buffer(self, connection:socket.Socket, file) -> None:
+    def read_chunks(self, file) -> Iterator[memoryview]:
+        # The chunks are views of 1 buffer (borrowed from `buffers`) that is
+        # reused for all of them, so each chunk has to be used up before the
+        # next one is read
+        if isinstance(file, MemoryFile):
+            view = memoryview(file.data)
+            for start in range(0, len(view), MAX_SEND_BUFFER):
+                yield view[start:start+MAX_SEND_BUFFER]
+            return None
+        file.seek(0)
+        # This can't wait for a buffer, in the asyncio engine it runs in the
+        # executor that the buffers' holders need to give them back
+        buffer = pooled = self.buffers.acquire(MAX_SEND_BUFFER, blocking=False)
+        if buffer is None:
+            buffer = bytearray(self.buffers.buffer_size(MAX_SEND_BUFFER))
         try:
-            data = b"Please stop looking at my code"
-            while len(data) != 0:
-                data = file.read(CHUNK_SIZE)
-                self.sendall(connection, data)
+            view = memoryview(buffer)
+            while True:
+                read = file.readinto(view)
+                if not read:
+                    break
+                yield view[:read]
         finally:
-            file.close()
+            view = None
+            if pooled is not None:
+                self.buffers.release(pooled)
+
+    def send_from_buffer(self, file, offset:int,
+                         count:int) -> Iterator[bytes|FileSlice]:
+        # The file is already in memory so don't copy it
+        if isinstance(file, MemoryFile):
+            if len(file.data) < offset+count:
+                raise FileTruncated("A file got shorter before it was sent.")
+            yield memoryview(file.data)[offset:offset+count]
+            return None
+        if USE_SENDFILE:
+            yield FileSlice(file, offset, count)
+            return None
+        key, mapping = self.mmap_pool.acquire(file)
+        if mapping is not None:
+            try:
+                view = memoryview(mapping)
+                end = offset + count
+                if len(view) < end:
+                    raise FileTruncated("A file got shorter before it was "
+                                        "sent.")
+                for start in range(offset, end, CHUNK_SIZE):
+                    yield view[start:min(start+CHUNK_SIZE, end)]
+            finally:
+                view = None
+                self.mmap_pool.release(key)
+            return None
+        # `sendall` reads it into one of the `buffers`
+        yield FileSlice(file, offset, count)
 
-    def send_folder(self, connection:socket.Socket, folder:str) -> None:
+    def send_folder(self, folder:str, request:Request,
+                    stat:os.stat_result) -> Iterator[bytes]:
         print("[Debug]: \t\tSending the contents of the folder.")
-        all_files = (file for file in os.listdir(folder) if os.path.isfile(os.path.join(folder, file)))
-        filtered_files = []
-        for file in all_files:
-            if file[-4:] == ".mp4":
-                file = file[:-4]
-            filtered_files.append(file)
-        ordered_files = tuple(sorted(sorted(filtered_files), key=len))
-        folders = tuple(file for file in os.listdir(folder) if not os.path.isfile(os.path.join(folder, file)))
-        all = tuple(sorted(sorted(folders), key=len)) + ordered_files
+        # The listing has to be rebuilt if the folder, ".ignore" or the
+        # templates change. Adding/removing a file changes the folder's mtime.
+        validator = (stat.st_mtime_ns, stat.st_ino, self.ignore.mtime,
+                     self.pages_mtime)
+        cached = self.listings.get(folder)
+        if (cached is None) or (cached[0] != validator) or \
+           (cached[1] < monotonic()):
+            cached = self.update_listing(folder, validator, cached)
+        _, _, etag, files, response = cached
 
-        try:
-            with open(".ignore", "r") as file:
-                ignored_files = file.read().split("\n")
-        except:
-            ignored_files = tuple()
-        all_with_ignore = []
+        encoding = self.get_encoding(request, "text/html")
+        if encoding is not None:
+            etag = f"{etag[:-1]}-{encoding}\""
+        headers = website_pages.validators(etag,
+                                           vary=self.varies("text/html"))
+        if self.not_modified(request, etag):
+            yield website_pages.not_modified(headers)
+            return None
+
+        if (response is not None) and (encoding is not None):
+            key = (folder, encoding)
+            cached = self.variants.get(key)
+            if (cached is not None) and (cached[0] == etag):
+                response = cached[1]
+            else:
+                response = website_pages.folder(files, encoding=encoding,
+                                                headers=headers)
+                self.variants.set(key, (etag, response), size=len(response))
+
+        if response is not None:
+            yield response
+        # HTTP/1.0 doesn't have "Transfer-Encoding: chunked"
+        elif request.version == "HTTP/1.0":
+            yield website_pages.folder(files, encoding=encoding,
+                                       headers=headers)
+        # Too big to keep in memory so stream it
+        else:
+            yield from website_pages.folder_chunked(files, encoding=encoding,
+                                                    headers=headers)
 
-        for filename in all:
-            path = filename.replace("\\", "/")
-            if folder != ".":
-                path = (folder+"/"+filename)
-            if path not in ignored_files:
-                all_with_ignore.append(filename)
+    def update_listing(self, folder:str, validator:tuple,
+                       cached:tuple) -> tuple:
+        # Reads the folder again and updates `self.listings`. The old
+        # listing is kept if nothing in it changed.
+        files = self.list_folder(folder)
+        expires = monotonic() + LISTING_TTL
+        if (cached is not None) and (cached[0] == validator) and \
+           (cached[3] == files):
+            cached = (validator, expires) + cached[2:]
+            self.listings.set(folder, cached, size=self.listing_size(cached))
+            return cached
+        # The ETag also changes when any of the files changes
+        newest = max((mtime for name, size, mtime in files), default=0)
+        etag = "-".join(f"{value or 0:x}" for value in validator)
+        etag = f"\"{etag}-{int(newest*1000):x}\""
+        response = None
+        if len(files) <= MAX_CACHED_LISTING_ENTRIES:
+            headers = website_pages.validators(etag,
+                                               vary=self.varies("text/html"))
+            response = website_pages.folder(files, headers=headers)
+        cached = (validator, expires, etag, files, response)
+        self.listings.set(folder, cached, size=self.listing_size(cached))
+        return cached
 
-        self.sendall(connection, website_pages.folder(tuple(all_with_ignore)))
+    def listing_size(self, cached:tuple) -> int:
+        # Big listings only keep the entries (roughly 100 bytes each)
+        if cached[4] is None:
+            return len(cached[3])*100
+        return len(cached[4])
 
-    def sendall(self, connection:socket.Socket, data:bytes) -> None:
+    def is_ignored(self, path:str) -> bool:
+        # The folder listings show "x.mp4" as "x" so ".ignore" can have either
+        if path.lower().endswith(".mp4") and self.ignore.is_ignored(path[:-4]):
+            return True
+        return self.ignore.is_ignored(path)
+
+    def list_folder(self, folder:str) -> tuple[tuple[str, int, int], ...]:
+        # Returns `(name, size, mtime)` for each entry. The size of folders
+        # is `None`. `scandir` already knows if each entry is a file or a
+        # folder so the only syscall per entry is the `stat`.
+        prefix = "" if folder == "." else folder+"/"
+        files, folders = [], []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if self.is_ignored(prefix+entry.name):
+                    continue
+                try:
+                    stat = entry.stat()
+                    is_file = entry.is_file()
+                except OSError:
+                    # Broken symlinks or files deleted while we are listing
+                    continue
+                if is_file:
+                    filename = entry.name
+                    if filename[-4:] == ".mp4":
+                        filename = filename[:-4]
+                    files.append((filename, stat.st_size, stat.st_mtime))
+                else:
+                    folders.append((entry.name, None, stat.st_mtime))
+        key = lambda entry: (len(entry[0]), entry[0])
+        return tuple(sorted(folders, key=key)) + tuple(sorted(files, key=key))
+
+    def sendall(self, connection:socket.Socket, data:bytes|FileSlice,
+                pacer:Pacer=None) -> bool:
+        # Returns `False` if the client closed the connection
         try:
-            connection.sendall(data)
-        except ConnectionAbortedError:
+            if pacer is None:
+                self.send(connection, data)
+                return True
+            # Sent in pieces so the limits are checked in between
+            size = PACING_CHUNK_SIZE if pacer.limited else SEND_PIECE_SIZE
+            for piece in self.split(data, size):
+                length = self.length(piece)
+                if pacer.limited:
+                    sleep(pacer.delay(length))
+                start = monotonic()
+                self.send(connection, piece, self.send_deadline(pacer, length))
+                pacer.record(length, monotonic()-start)
+                self.check_rate(pacer)
+        except (ConnectionAbortedError, ConnectionResetError, BrokenPipeError):
+            return False
+        return True
+
+    def send(self, connection:socket.Socket, data:bytes|FileSlice,
+             deadline:float=None) -> None:
+        # Raises `SlowClient` if it isn't done by `deadline`
+        if isinstance(data, FileSlice) and USE_SENDFILE:
+            self.sendfile(connection, data, deadline)
+        elif isinstance(data, FileSlice):
+            self.send_slice(connection, data, deadline)
+        else:
+            self.send_bytes(connection, data, deadline)
+
+    def sendfile(self, connection:socket.Socket, data:FileSlice,
+                 deadline:float=None) -> None:
+        # Like `connection.sendfile` but with the same timeouts as
+        # `send_bytes`. The socket has a timeout so it's non-blocking
+        # underneath.
+        socket_fd, file_fd = connection.fileno(), data.file.fileno()
+        poller = select.poll()
+        poller.register(socket_fd, select.POLLOUT)
+        offset, end = data.offset, data.offset+data.count
+        while offset < end:
+            try:
+                sent = os.sendfile(socket_fd, file_fd, offset, end-offset)
+            except BlockingIOError:
+                queued = self.queued(connection)
+                wait = self.send_wait(deadline)
+                if len(poller.poll(wait*1000)) == 0:
+                    self.check_progress(connection, wait, queued)
+                continue
+            if sent == 0:
+                # The end of the file
+                break
+            offset += sent
+        self.check_sent(data, offset-data.offset)
+
+    def check_sent(self, data:FileSlice, sent:int) -> None:
+        # `sendfile` stops early (without an error) at the end of the file
+        if sent < data.count:
+            raise FileTruncated(f"Only {sent} of {data.count} bytes could be "
+                                f"sent from {data.file.name!r}.")
+
+    def send_bytes(self, connection:socket.Socket, data:bytes,
+                   deadline:float=None) -> None:
+        # Like `connection.sendall` but the socket's timeout is for each
+        # `send` (so it only runs out if the client stops reading) and it
+        # gives up at `deadline`
+        data = memoryview(data)
+        while len(data) > 0:
+            queued = self.queued(connection)
+            wait = self.send_wait(deadline)
+            connection.settimeout(wait)
+            try:
+                data = data[connection.send(data):]
+            except TimeoutError:
+                self.check_progress(connection, wait, queued)
+
+    def check_rate(self, pacer:Pacer) -> None:
+        if (MIN_SEND_RATE is not None) and \
+           pacer.too_slow(MIN_SEND_RATE, MIN_RATE_GRACE):
+            raise SlowClient("The client is reading too slowly.")
+
+    def send_deadline(self, pacer:Pacer, length:int) -> float:
+        # When sending the next `length` bytes has to be done by (`None`
+        # means never). Until `MIN_RATE_GRACE` is over, the first sends only
+        # fill the socket's buffers so they get at least the rest of it.
+        if MIN_SEND_RATE is None:
+            return None
+        grace = MIN_RATE_GRACE - pacer.send_time
+        return monotonic() + max(grace, length/MIN_SEND_RATE)
+
+    def send_wait(self, deadline:float) -> float:
+        # How long to wait for the client to read something before the next
+        # `send`: `SEND_TIMEOUT` or less if `deadline` comes first
+        if deadline is None:
+            return SEND_TIMEOUT
+        left = deadline - monotonic()
+        if left <= 0:
+            raise SlowClient("The client is reading too slowly.")
+        return min(SEND_TIMEOUT, left)
+
+    def check_progress(self, connection:socket.Socket, wait:float,
+                       queued:int) -> None:
+        # Called when the kernel didn't have room for more data for `wait`
+        # seconds (`queued` is what `queued` returned before that). Raises
+        # `SlowClient` if the deadline ran out or `TimeoutError` if the
+        # client didn't read anything. The kernel only makes room once a
+        # big part of its buffer was read, so a slow client that is still
+        # reading gets until the deadline.
+        if wait < SEND_TIMEOUT:
+            raise SlowClient("The client is reading too slowly.")
+        now = self.queued(connection)
+        if (queued is None) or (now is None) or (now >= queued):
+            raise TimeoutError("The client stopped reading.")
+
+    def queued(self, connection:socket.Socket) -> int:
+        # The bytes in the kernel's send queue that the client hasn't read
+        # yet or `None` if the platform can't tell (`SIOCOUTQ` is Linux's)
+        if (ioctl is None) or (not sys.platform.startswith("linux")):
             return None
-        except ConnectionResetError:
+        try:
+            result = ioctl(connection.fileno(), SIOCOUTQ, bytes(4))
+        except OSError:
             return None
+        return struct.unpack("i", result)[0]
+
+    async def async_sendall(self, connection:socket.Socket,
+                            data:bytes|FileSlice, pacer:Pacer=None) -> bool:
+        # Returns `False` if the client closed the connection
+        try:
+            if pacer is None:
+                await self.async_send(connection, data)
+                return True
+            # Sent in pieces so the limits are checked in between
+            size = PACING_CHUNK_SIZE if pacer.limited else SEND_PIECE_SIZE
+            for piece in self.split(data, size):
+                length = self.length(piece)
+                if pacer.limited:
+                    await asyncio.sleep(pacer.delay(length))
+                start = monotonic()
+                await self.async_send(connection, piece,
+                                      self.send_deadline(pacer, length))
+                pacer.record(length, monotonic()-start)
+                self.check_rate(pacer)
+        except (ConnectionAbortedError, ConnectionResetError, BrokenPipeError):
+            return False
+        return True
+
+    async def async_send(self, connection:socket.Socket,
+                         data:bytes|FileSlice, deadline:float=None) -> None:
+        # Raises `SlowClient` if it isn't done by `deadline`
+        if isinstance(data, FileSlice) and USE_SENDFILE:
+            await self.async_sendfile(connection, data, deadline)
+        elif isinstance(data, FileSlice):
+            await self.async_send_slice(connection, data, deadline)
+        else:
+            await self.async_send_bytes(connection, data, deadline)
+
+    async def async_sendfile(self, connection:socket.Socket, data:FileSlice,
+                             deadline:float=None) -> None:
+        # Like `sendfile` but waits on the event loop
+        socket_fd, file_fd = connection.fileno(), data.file.fileno()
+        offset, end = data.offset, data.offset+data.count
+        while offset < end:
+            try:
+                sent = os.sendfile(socket_fd, file_fd, offset, end-offset)
+            except BlockingIOError:
+                await self.async_wait_writable(connection, deadline)
+                continue
+            if sent == 0:
+                # The end of the file
+                break
+            offset += sent
+        self.check_sent(data, offset-data.offset)
+
+    async def async_send_bytes(self, connection:socket.Socket, data:bytes,
+                               deadline:float=None) -> None:
+        # Like `send_bytes` but waits on the event loop
+        data = memoryview(data)
+        while len(data) > 0:
+            try:
+                data = data[connection.send(data):]
+            except BlockingIOError:
+                await self.async_wait_writable(connection, deadline)
+
+    async def async_wait_writable(self, connection:socket.Socket,
+                                  deadline:float=None) -> None:
+        # Waits (at most `send_wait`) until the kernel has room for more
+        # data, see `check_progress`
+        writable = self.loop.create_future()
+        def on_writable() -> None:
+            if not writable.done():
+                writable.set_result(None)
+        queued = self.queued(connection)
+        wait = self.send_wait(deadline)
+        self.loop.add_writer(connection, on_writable)
+        try:
+            await asyncio.wait_for(writable, wait)
+        except TimeoutError:
+            self.check_progress(connection, wait, queued)
+        finally:
+            self.loop.remove_writer(connection)
+
+    def split(self, data:bytes|FileSlice,
+              size:int) -> Iterator[memoryview|FileSlice]:
+        # Splits `data` into pieces of at most `size` bytes
+        if isinstance(data, FileSlice):
+            for start in range(0, data.count, size):
+                yield FileSlice(data.file, data.offset+start,
+                                min(size, data.count-start))
+        else:
+            data = memoryview(data)
+            for start in range(0, len(data), size):
+                yield data[start:start+size]
+
+    def length(self, data:bytes|FileSlice) -> int:
+        if isinstance(data, FileSlice):
+            return data.count
+        return len(data)
+
+    def send_slice(self, connection:socket.Socket, data:FileSlice,
+                   deadline:float=None) -> None:
+        size = connection.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        buffer = self.buffers.acquire(min(size, data.count))
+        try:
+            view = memoryview(buffer)
+            data.file.seek(data.offset)
+            count = data.count
+            while count > 0:
+                read = data.file.readinto(view[:min(count, len(view))])
+                if not read:
+                    self.check_sent(data, data.count-count)
+                self.send_bytes(connection, view[:read], deadline)
+                count -= read
+        finally:
+            view = None
+            self.buffers.release(buffer)
+
+    async def async_send_slice(self, connection:socket.Socket,
+                               data:FileSlice, deadline:float=None) -> None:
+        # Reading the file blocks so it happens in another thread
+        size = connection.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        buffer = await self.async_acquire_buffer(min(size, data.count))
+        try:
+            view = memoryview(buffer)
+            data.file.seek(data.offset)
+            count = data.count
+            while count > 0:
+                read = await self.loop.run_in_executor(self.executor,
+                                                       data.file.readinto,
+                                                       view[:min(count, len(view))])
+                if not read:
+                    self.check_sent(data, data.count-count)
+                await self.async_send_bytes(connection, view[:read], deadline)
+                count -= read
+        finally:
+            view = None
+            self.buffers.release(buffer)
+
+    async def async_acquire_buffer(self, size:int) -> bytearray:
+        # Waits for `buffers.release` (through `buffer_released`) without
+        # blocking the event loop or one of the executor's threads
+        while True:
+            buffer = self.buffers.acquire(size, blocking=False)
+            if buffer is not None:
+                return buffer
+            self.buffer_released.clear()
+            await self.buffer_released.wait()
+
+    def serve_supervisor(self, connection) -> None:
+        # Answers the `Supervisor` that started this process
+        while self.running:
+            try:
+                command = connection.recv()
+            except (EOFError, OSError):
+                # The supervisor died
+                self.stop()
+                break
+            if command == "stats":
+                connection.send(self.get_stats())
+            elif command == "stop":
+                self.stop()
+            elif command == "drain":
+                self.drain()
+
+    def connection_stats(self) -> dict[str, int]:
+        with self.connections_lock:
+            return dict(open=len(self.connections),
+                        ips=len(self.ip_connections),
+                        rejected_ip=self.rejected["ip"],
+                        rejected_total=self.rejected["total"],
+                        header_timeouts=self.timeouts["header"],
+                        send_timeouts=self.timeouts["send"],
+                        too_slow=self.timeouts["slow"],
+                        aborted=self.aborted)
+
+    def get_stats(self) -> dict[str, dict[str, int]]:
+        return {"content_cache": self.content_cache.stats(),
+                "mmap_pool": self.mmap_pool.stats(),
+                "buffers": self.buffers.stats(),
+                "rate_limit": self.limiter.stats(),
+                "connections": self.connection_stats()}
 
     def stop(self) -> None:
         if not self.running:
             return None
         self.running = False
-        self.socket.close()
+        if self.server_task is not None:
+            self.loop.call_soon_threadsafe(self.server_task.cancel)
+        if self.pool is not None:
+            self.pool.stop()
+        if self.idle is not None:
+            self.idle.stop()
+        if self.socket is not None:
+            self.socket.close()
         sys.stderr.write("Stopped server.\n")
 
 
+def make_listener(port:int, reuse_port:bool=False) -> socket.Socket:
+    listener = socket.Socket(socket.AF_INET, socket.SOCK_STREAM)
+    if reuse_port:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind(("0.0.0.0", port))
+    listener.listen()
+    return listener
+
+
+def inherited_listener() -> socket.Socket:
+    # The listening socket passed to us by the process that started us. Either
+    # by `start_successor` ("HOSTER_LISTEN_FD") or by systemd ("LISTEN_FDS").
+    fd = os.environ.pop("HOSTER_LISTEN_FD", None)
+    if os.environ.pop("LISTEN_FDS", "0") != "0":
+        if os.environ.pop("LISTEN_PID", str(os.getpid())) == str(os.getpid()):
+            # SD_LISTEN_FDS_START
+            fd = 3
+    os.environ.pop("LISTEN_FDNAMES", None)
+    if fd is None:
+        return None
+    return socket.Socket(fileno=int(fd))
+
+
+def start_successor(listener:socket.Socket=None,
+                    timeout:float=10) -> subprocess.Popen:
+    # Starts a new copy of this program that takes over `listener` (without
+    # `listener` it binds the port itself, so it needs `SO_REUSEPORT`) and
+    # waits (at most `timeout` seconds) until it accepts connections so we
+    # can stop accepting them. Returns `None` (after killing it) if it
+    # didn't get that far.
+    sys.stderr.write("Starting a new server process.\n")
+    env = dict(os.environ)
+    ready, ready_writer = os.pipe()
+    env["HOSTER_READY_FD"] = str(ready_writer)
+    fds = (ready_writer, )
+    if listener is not None:
+        env["HOSTER_LISTEN_FD"] = str(listener.fileno())
+        fds += (listener.fileno(), )
+    process = subprocess.Popen([sys.executable] + sys.argv, env=env,
+                               pass_fds=fds)
+    os.close(ready_writer)
+    try:
+        readable, _, _ = select.select([ready], [], [], timeout)
+        # If it died, the pipe is closed without the byte from `signal_ready`
+        started = (len(readable) > 0) and (os.read(ready, 1) == b"\x00")
+    finally:
+        os.close(ready)
+    if not started:
+        sys.stderr.write("The new server process didn't start.\n")
+        process.kill()
+        process.wait()
+        return None
+    return process
+
+
+def should_drain(signals:list[int], listener:socket.Socket=None) -> bool:
+    # Handles (and removes) the signals in `signals`: SIGTERM means drain,
+    # SIGUSR2 starts a new server process (that gets `listener`) and only
+    # drains if it started, otherwise we have to keep serving
+    sigusr2 = getattr(signal, "SIGUSR2", None)
+    received = []
+    while signals:
+        received.append(signals.pop(0))
+    drain = any(signum != sigusr2 for signum in received)
+    if sigusr2 in received:
+        drain |= start_successor(listener) is not None
+    return drain
+
+
+def signal_ready() -> None:
+    # Tells the process that started us with `start_successor` that we are
+    # accepting connections
+    fd = os.environ.pop("HOSTER_READY_FD", None)
+    if fd is None:
+        return None
+    try:
+        os.write(int(fd), b"\x00")
+        os.close(int(fd))
+    except OSError:
+        pass
+
+
+def write_stats(stats:dict[str, dict[str, int]]) -> None:
+    for name, values in stats.items():
+        values = ", ".join(f"{key}={value}" for key, value in values.items())
+        sys.stderr.write(f"[Stats]: {name}: {values}\n")
+
+
+def on_stats_signal(get_stats) -> None:
+    # Makes `STATS_SIGNAL` call `write_stats(get_stats())`. It runs in its own
+    # thread so it can't deadlock with whatever the signal interrupted.
+    if not hasattr(signal, STATS_SIGNAL):
+        return None
+    def handler(signum:int, frame) -> None:
+        Thread(target=lambda: write_stats(get_stats()), daemon=True).start()
+    signal.signal(getattr(signal, STATS_SIGNAL), handler)
+
+
+def run_worker(index:int, connection, port:int, engine:str,
+               listener:socket.Socket) -> None:
+    # Runs in each of the processes started by `main_prefork`
+    server = FTPServer(port, engine=engine, listener=listener,
+                       reuse_port=listener is None)
+    server.start_server()
+    connection.send("ready")
+    thread = Thread(target=server.serve_supervisor, args=(connection, ),
+                    daemon=True)
+    thread.start()
+    while server.running:
+        sleep(0.2)
+
+
+def main_prefork(port:int=80) -> None:
+    workers = WORKERS or os.cpu_count() or 1
+    print(f"Starting {workers} workers. Press `Ctrl-C` to stop the server.")
+    # Without `SO_REUSEPORT`, the workers inherit this socket
+    listener = inherited_listener()
+    if (listener is None) and (not REUSE_PORT):
+        listener = make_listener(port)
+    supervisor = Supervisor(run_worker, workers=workers,
+                            args=(port, ENGINE, listener),
+                            affinity=WORKER_AFFINITY)
+    supervisor.start()
+    supervisor.wait_ready()
+    signal_ready()
+    on_stats_signal(supervisor.get_stats)
+
+    # SIGTERM drains the workers, SIGUSR2 starts a new server process (that
+    # gets our socket) first
+    drain = []
+    def on_signal(signum:int, frame) -> None:
+        drain.append(signum)
+        supervisor.running = False
+    for name in ("SIGTERM", "SIGUSR2"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), on_signal)
+
+    draining = False
+    try:
+        while not draining:
+            supervisor.run() # Until `on_signal`
+            # Before `should_drain` so a signal that it doesn't see isn't lost
+            supervisor.running = True
+            draining = should_drain(drain, listener)
+    except KeyboardInterrupt:
+        sys.stderr.write("KeyboardInterrupt\n")
+    finally:
+        if draining:
+            supervisor.stop(timeout=DRAIN_TIMEOUT+5, command="drain")
+        else:
+            supervisor.stop()
+        if listener is not None:
+            listener.close()
+
+
 def main_gui() -> None:
     global server, redirector
     from libraries import stdout_redirector
@@ -225,12 +1706,26 @@ def main_gui() -> None:
 def main() -> None:
     global server
     print("Press `Ctrl-C` to stop the server.")
-    server = FTPServer()
+    server = FTPServer(listener=inherited_listener())
     server.start_server()
+    signal_ready()
+    if DEV_MODE and hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda *args: server.request_reload())
+    on_stats_signal(server.get_stats)
+
+    # SIGTERM drains the server, SIGUSR2 starts a new server process (that
+    # gets our socket) first
+    drain = []
+    for name in ("SIGTERM", "SIGUSR2"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name),
+                          lambda signum, frame: drain.append(signum))
 
     try:
         while server.running:
             sleep(0.2)
+            if drain and should_drain(drain, server.socket):
+                server.drain()
     except KeyboardInterrupt:
         server.stop()
         sys.stderr.write("KeyboardInterrupt\n")
@@ -239,5 +1734,7 @@ def main() -> None:
 if __name__ == "__main__":
     if GUI:
         main_gui()
+    elif WORKERS != 1:
+        main_prefork()
     else:
         main()
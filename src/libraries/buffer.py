@@ -1,4 +1,5 @@
 from __future__ import annotations
+from threading import Condition
 
 
 class BytesBuffer:
@@ -30,3 +31,110 @@ class BytesBuffer:
 
     def close(self) -> None:
         self.data = b""
+
+
+class MemoryFile:
+    """
+    A read only file whose contents (`data`) are already in memory.
+    """
+    __slots__ = ("data", "position")
+
+    def __init__(self, data:bytes):
+        self.data = data
+        self.position = 0
+
+    def __enter__(self) -> MemoryFile:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def read(self, size:int=-1) -> bytes:
+        start = self.position
+        if (size < 0) or (start+size > len(self.data)):
+            size = len(self.data)-start
+        self.position += size
+        return self.data[start:start+size]
+
+    def seek(self, position:int) -> int:
+        self.position = position
+        return position
+
+    def close(self) -> None:
+        return None
+
+
+class BufferPool:
+    """
+    Reusable `bytearray`s for reading files into (with `readinto`). Their
+    sizes are powers of 2 between `min_size` and `max_size`. All of them
+    together are never bigger than `max_bytes`, if there isn't enough space,
+    `acquire` waits until another thread releases a buffer. `on_release` (if
+    it isn't `None`) is called after each `release`, for waiters that can't
+    block a thread.
+    Usage:
+        pool = BufferPool(max_bytes=1024*1024*64)
+        buffer = pool.acquire(1024*64)
+        try:
+            read = file.readinto(buffer)
+            connection.sendall(memoryview(buffer)[:read])
+        finally:
+            pool.release(buffer)
+    """
+    __slots__ = ("free", "condition", "max_bytes", "bytes", "min_size",
+                 "max_size", "waits", "on_release")
+
+    def __init__(self, max_bytes:int, min_size:int=1024*16,
+                 max_size:int=1024*1024):
+        # {size: [bytearray, ...]}
+        self.free = {}
+        self.condition = Condition()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.min_size = min_size
+        self.max_size = min(max_size, max_bytes)
+        self.waits = 0
+        self.on_release = None
+
+    def buffer_size(self, size:int) -> int:
+        size = min(max(size, self.min_size), self.max_size)
+        # Round down to a power of 2 so there are only a few sizes
+        return 1 << (size.bit_length()-1)
+
+    def acquire(self, size:int, blocking:bool=True) -> bytearray:
+        # Returns `None` if `blocking` is `False` and it would have to wait
+        size = self.buffer_size(size)
+        with self.condition:
+            while True:
+                free = self.free.get(size, None)
+                if free:
+                    return free.pop()
+                if self.bytes+size <= self.max_bytes:
+                    self.bytes += size
+                    return bytearray(size)
+                # Make space by throwing away unused buffers of other sizes
+                if self.drop_free():
+                    continue
+                self.waits += 1
+                if not blocking:
+                    return None
+                self.condition.wait()
+
+    def drop_free(self) -> bool:
+        for free in self.free.values():
+            if free:
+                self.bytes -= len(free.pop())
+                return True
+        return False
+
+    def release(self, buffer:bytearray) -> None:
+        with self.condition:
+            self.free.setdefault(len(buffer), []).append(buffer)
+            self.condition.notify()
+        if self.on_release is not None:
+            self.on_release()
+
+    def stats(self) -> dict[str, int]:
+        with self.condition:
+            free = sum(map(len, self.free.values()))
+            return dict(bytes=self.bytes, free=free, waits=self.waits)
@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from typing import Iterator
+from threading import Lock
+
+
+class FrequencySketch:
+    """
+    Roughly counts how many times each key was seen using 4 rows of
+    counters (a count-min sketch) that stop at 15. All of the counters are
+    halved every `sample_size` increments so keys that used to be popular
+    don't stay popular forever.
+    """
+    __slots__ = ("rows", "mask", "additions", "sample_size")
+
+    SEEDS = (0x5bd1e995, 0x27d4eb2f, 0x165667b1, 0x9e3779b1)
+
+    def __init__(self, width:int=1024):
+        # Round up to a power of 2 so that `hash & mask` can be the index
+        width = 1 << max(width-1, 1).bit_length()
+        self.rows = tuple(bytearray(width) for seed in self.SEEDS)
+        self.mask = width-1
+        self.additions = 0
+        self.sample_size = width*10
+
+    def indexes(self, key) -> Iterator[tuple[bytearray, int]]:
+        key = hash(key)
+        for row, seed in zip(self.rows, self.SEEDS):
+            yield row, hash((seed, key)) & self.mask
+
+    def increment(self, key) -> None:
+        for row, i in self.indexes(key):
+            if row[i] < 15:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.additions //= 2
+            for row in self.rows:
+                row[:] = bytes(count >> 1 for count in row)
+
+    def frequency(self, key) -> int:
+        return min(row[i] for row, i in self.indexes(key))
+
+
+class ContentCache:
+    """
+    Keeps the contents of small files in memory. The sizes of the cached
+    files add up to at most `max_bytes`. When it's full, a new file is only
+    added if it was asked for more often than all of the (least recently
+    used) files that would have to be removed to make space for it (like
+    TinyLFU). That way reading a lot of files once can't remove the
+    popular ones.
+    Usage:
+        cache = ContentCache(max_bytes=1024*1024*64)
+        data = cache.get(key)
+        if data is None:
+            data = file.read()
+            cache.put(key, data)
+    """
+    __slots__ = ("data", "lock", "max_bytes", "bytes", "sketch", "hits",
+                 "misses", "admitted", "rejected")
+
+    def __init__(self, max_bytes:int, expected_entries:int=1024):
+        # {key: bytes} from least to most recently used
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.sketch = FrequencySketch(expected_entries)
+        self.hits = 0
+        self.misses = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get(self, key) -> bytes:
+        with self.lock:
+            self.sketch.increment(key)
+            data = self.data.get(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data:bytes) -> bool:
+        # Returns `True` if `data` was added to the cache
+        size = len(data)
+        with self.lock:
+            if (key in self.data) or (size > self.max_bytes):
+                return False
+            frequency = self.sketch.frequency(key)
+            victims, freed = [], 0
+            for victim in self.data:
+                if self.bytes-freed+size <= self.max_bytes:
+                    break
+                if self.sketch.frequency(victim) >= frequency:
+                    self.rejected += 1
+                    return False
+                victims.append(victim)
+                freed += len(self.data[victim])
+            for victim in victims:
+                del self.data[victim]
+            self.bytes -= freed
+            self.data[key] = data
+            self.bytes += size
+            self.admitted += 1
+            return True
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        admitted=self.admitted, rejected=self.rejected,
+                        entries=len(self.data), bytes=self.bytes)
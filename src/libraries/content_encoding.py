@@ -0,0 +1,103 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# The encodings we can send, best first
+if zstandard is None:
+    ENCODINGS = ("gzip", "deflate")
+else:
+    ENCODINGS = ("zstd", "gzip", "deflate")
+
+# Everything that starts with "text/" is also compressible
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/javascript",
+                          "application/x-httpd-php", "image/svg+xml",
+                          "image/bmp", "image/icon"}
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def is_compressible(mimetype:str) -> bool:
+    return mimetype.startswith("text/") or (mimetype in COMPRESSIBLE_MIMETYPES)
+
+
+def negotiate(accept_encoding:str, encodings:tuple[str]=ENCODINGS) -> str:
+    """
+    Picks the encoding to use from the value of an "Accept-Encoding" header.
+    Returns `None` if the body shouldn't be compressed.
+    For example: "gzip;q=0.5, deflate, br" => "deflate"
+    """
+    encodings = acceptable(accept_encoding, encodings)
+    if len(encodings) == 0:
+        return None
+    return encodings[0]
+
+
+def acceptable(accept_encoding:str, encodings:tuple[str]=ENCODINGS) -> list[str]:
+    # All of the `encodings` that the client accepts, best first
+    if not accept_encoding:
+        return []
+    qualities = {}
+    for item in accept_encoding.lower().split(","):
+        name, *params = item.split(";")
+        quality = 1
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        qualities[name.strip()] = quality
+
+    encodings = [(qualities.get(encoding, qualities.get("*", 0)), i, encoding)
+                 for i, encoding in enumerate(encodings)]
+    return [encoding for quality, i, encoding in sorted(encodings,
+                                                         key=lambda x: (-x[0], x[1]))
+            if quality > 0]
+
+
+class Compressor:
+    """
+    Compresses data a bit at a time:
+        compressor = Compressor("gzip")
+        data = compressor.compress(b"abc") + compressor.flush()
+        data += compressor.compress(b"def") + compressor.finish()
+    `flush` makes sure that everything passed to `compress` so far can be
+    decompressed by the client (without ending the stream).
+    """
+    __slots__ = ("encoding", "compressor")
+
+    def __init__(self, encoding:str):
+        self.encoding = encoding
+        if encoding == "zstd":
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            self.compressor = compressor.compressobj()
+        elif encoding == "gzip":
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        elif encoding == "deflate":
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 15)
+        else:
+            raise ValueError(f"Unknown encoding: {encoding!r}")
+
+    def compress(self, data:bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        if self.encoding == "zstd":
+            return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "zstd":
+            return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+def compress(data:bytes, encoding:str) -> bytes:
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
@@ -0,0 +1,136 @@
+from urllib.parse import unquote_to_bytes
+import ntpath
+
+
+MAX_HEADER_SIZE = 1024*16
+MAX_HEADERS = 100
+MAX_BODY_SIZE = 1024*64
+
+
+class BadRequest(Exception):
+    """
+    Raised by `RequestParser` when the client sent something that isn't a
+    valid HTTP request. `status` is the status line that should be sent
+    back before closing the connection.
+    """
+    def __init__(self, status:str="400 Bad Request"):
+        super().__init__(status)
+        self.status = status
+
+
+class Request:
+    __slots__ = ("method", "target", "version", "headers", "body")
+
+    def __init__(self, method:str, target:bytes, version:str,
+                 headers:dict[str, str], body:bytes=b""):
+        self.method = method
+        self.target = target
+        self.version = version
+        # The names of the headers are lowercase
+        self.headers = headers
+        self.body = body
+
+    def __repr__(self) -> str:
+        return f"Request({self.method} {self.target!r} {self.version})"
+
+    @property
+    def path(self) -> str:
+        # The target without the query and the leading "/" with all of the
+        # "%xx"s decoded. For example: b"/a%20b.mp4?t=1" => "a b.mp4"
+        # Raises `BadRequest` if the path would leave the served folder (it's
+        # absolute, like "//etc/passwd" or "/%2Fetc/passwd", or has "..").
+        path = self.target.partition(b"?")[0]
+        path = unquote_to_bytes(path[1:]).decode("utf-8", errors="replace")
+        if path.startswith(("/", "\\")) or ntpath.splitdrive(path)[0]:
+            raise BadRequest()
+        if ".." in path.replace("\\", "/").split("/"):
+            raise BadRequest()
+        return path
+
+
+class RequestParser:
+    """
+    Collects the data received from a connection and splits it into
+    `Request`s. The data can arrive in any number of pieces and can contain
+    more than 1 request (pipelining).
+    Usage:
+        parser = RequestParser()
+        while True:
+            request = parser.next_request()
+            if request is None:
+                parser.feed(connection.recv(4096))
+                continue
+            ...
+    """
+    __slots__ = ("buffer", "scanned", "max_header_size", "max_headers")
+
+    def __init__(self, max_header_size:int=MAX_HEADER_SIZE,
+                 max_headers:int=MAX_HEADERS):
+        self.buffer = bytearray()
+        # How much of `buffer` we already know doesn't contain b"\r\n\r\n"
+        self.scanned = 0
+        self.max_header_size = max_header_size
+        self.max_headers = max_headers
+
+    def feed(self, data:bytes) -> None:
+        self.buffer += data
+
+    def next_request(self) -> Request:
+        # Returns `None` if we need more data for the next request
+        end = self.buffer.find(b"\r\n\r\n", max(self.scanned-3, 0))
+        if end == -1:
+            self.scanned = len(self.buffer)
+            if self.scanned > self.max_header_size:
+                raise BadRequest("431 Request Header Fields Too Large")
+            return None
+        if end > self.max_header_size:
+            raise BadRequest("431 Request Header Fields Too Large")
+
+        lines = bytes(self.buffer[:end]).split(b"\r\n")
+        request = self.parse_request_line(lines[0])
+        request.headers = self.parse_headers(lines[1:])
+
+        if "transfer-encoding" in request.headers:
+            raise BadRequest("501 Not Implemented")
+        length = request.headers.get("content-length", "0")
+        if not length.isdigit():
+            raise BadRequest()
+        length = int(length)
+        if length > MAX_BODY_SIZE:
+            raise BadRequest("413 Content Too Large")
+        if len(self.buffer) < end+4+length:
+            # Wait for the rest of the body
+            self.scanned = end
+            return None
+
+        request.body = bytes(self.buffer[end+4:end+4+length])
+        del self.buffer[:end+4+length]
+        self.scanned = 0
+        return request
+
+    def parse_request_line(self, line:bytes) -> Request:
+        parts = line.split(b" ")
+        if (len(parts) != 3) or (not parts[2].startswith(b"HTTP/")):
+            raise BadRequest()
+        method, target, version = parts
+        if not target.startswith(b"/"):
+            raise BadRequest()
+        return Request(method.decode("latin-1"), target,
+                       version.decode("latin-1"), {})
+
+    def parse_headers(self, lines:list[bytes]) -> dict[str, str]:
+        if len(lines) > self.max_headers:
+            raise BadRequest("431 Request Header Fields Too Large")
+        headers = {}
+        for line in lines:
+            name, colon, value = line.partition(b":")
+            # No "name : value" and no folded (multi-line) headers
+            if (not colon) or (name != name.strip()) or (len(name) == 0):
+                raise BadRequest()
+            name = name.decode("latin-1").lower()
+            value = value.strip().decode("latin-1")
+            if name in headers:
+                headers[name] += ", " + value
+            else:
+                headers[name] = value
+        return headers
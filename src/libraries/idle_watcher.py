@@ -0,0 +1,127 @@
+from threading import Thread, Lock
+from itertools import count
+from time import monotonic
+import traceback
+import selectors
+import socket
+import heapq
+
+
+class IdleWatcher:
+    """
+    Waits (in 1 thread) for connections that have nothing to do until the
+    client sends something, so they don't each hold on to a thread.
+    `on_ready(connection, data)` is called once the connection becomes
+    readable and `on_timeout(connection, data)` if it doesn't before its
+    deadline (or when the watcher stops). Both are called in the watcher's
+    thread and the connection isn't watched anymore after either of them.
+    Usage:
+        watcher = IdleWatcher(on_ready=pool.put, on_timeout=close)
+        watcher.start()
+        watcher.watch(connection, session, deadline=monotonic()+15)
+    """
+    __slots__ = ("on_ready", "on_timeout", "selector", "waiting", "deadlines",
+                 "new", "lock", "wakeup", "running", "counter")
+
+    def __init__(self, on_ready, on_timeout):
+        self.on_ready = on_ready
+        self.on_timeout = on_timeout
+        self.selector = selectors.DefaultSelector()
+        # {connection: (deadline, data)}
+        self.waiting = {}
+        # A heap of `(deadline, n, connection)`. Entries for connections
+        # that stopped waiting are skipped when they get to the top.
+        self.deadlines = []
+        self.counter = count()
+        # `watch` is called from other threads so the connections are only
+        # registered by the watcher's thread
+        self.new = []
+        self.lock = Lock()
+        self.wakeup = socket.socketpair()
+        for sock in self.wakeup:
+            sock.setblocking(False)
+        self.running = False
+
+    def start(self) -> None:
+        self.running = True
+        self.selector.register(self.wakeup[0], selectors.EVENT_READ)
+        Thread(target=self.run, daemon=True).start()
+
+    def watch(self, connection:socket.socket, data, deadline:float) -> None:
+        with self.lock:
+            self.new.append((connection, data, deadline))
+        self.wake()
+
+    def stop(self) -> None:
+        self.running = False
+        self.wake()
+
+    def __len__(self) -> int:
+        return len(self.waiting)
+
+    def wake(self) -> None:
+        try:
+            self.wakeup[1].send(b"\x00")
+        except OSError:
+            # Already full (so it's going to wake up anyway) or closed
+            pass
+
+    def run(self) -> None:
+        while self.running:
+            self.register_new()
+            timeout = None
+            if self.deadlines:
+                timeout = max(self.deadlines[0][0]-monotonic(), 0)
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is self.wakeup[0]:
+                    self.clear_wakeup()
+                else:
+                    self.finish(key.fileobj, self.on_ready)
+            self.expire()
+        # Everything that is still waiting times out
+        self.register_new()
+        for connection in tuple(self.waiting):
+            self.finish(connection, self.on_timeout)
+        self.selector.close()
+        for sock in self.wakeup:
+            sock.close()
+
+    def register_new(self) -> None:
+        with self.lock:
+            new, self.new = self.new, []
+        for connection, data, deadline in new:
+            self.waiting[connection] = (deadline, data)
+            try:
+                self.selector.register(connection, selectors.EVENT_READ)
+            except (ValueError, OSError):
+                # Already closed
+                self.finish(connection, self.on_timeout)
+                continue
+            heapq.heappush(self.deadlines,
+                           (deadline, next(self.counter), connection))
+
+    def clear_wakeup(self) -> None:
+        try:
+            while self.wakeup[0].recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def expire(self) -> None:
+        now = monotonic()
+        while self.deadlines and (self.deadlines[0][0] <= now):
+            deadline, _, connection = heapq.heappop(self.deadlines)
+            waiting = self.waiting.get(connection, None)
+            if (waiting is not None) and (waiting[0] == deadline):
+                self.finish(connection, self.on_timeout)
+
+    def finish(self, connection:socket.socket, callback) -> None:
+        deadline, data = self.waiting.pop(connection)
+        try:
+            self.selector.unregister(connection)
+        except (KeyError, ValueError):
+            pass
+        try:
+            callback(connection, data)
+        except Exception:
+            traceback.print_exc()
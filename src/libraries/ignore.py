@@ -0,0 +1,88 @@
+from threading import Lock
+import posixpath
+import fnmatch
+import os
+import re
+
+
+class IgnoreRules:
+    """
+    The rules from an ".ignore" file. Each line is a path relative to the
+    folder that is being served. Lines with "*", "?" or "[" in them are
+    globs, the rest have to match exactly (ignoring the case on Windows).
+    Ignoring a folder also ignores everything inside it. Empty lines and
+    lines that start with "#" are skipped.
+    The file is only parsed again when its mtime changes:
+        rules = IgnoreRules(".ignore")
+        rules.reload()
+        rules.is_ignored("secret/passwords.txt")
+    """
+    __slots__ = ("filename", "mtime", "exact", "pattern", "lock")
+
+    def __init__(self, filename:str=".ignore"):
+        self.filename = filename
+        self.mtime = None
+        self.exact = frozenset()
+        self.pattern = None
+        self.lock = Lock()
+
+    def reload(self) -> None:
+        # Parses the file again if it changed since the last time
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return None
+        with self.lock:
+            if mtime == self.mtime:
+                return None
+            try:
+                with open(self.filename, "r") as file:
+                    lines = file.read().split("\n")
+            except OSError:
+                lines = []
+            self.compile(lines)
+            self.mtime = mtime
+
+    def compile(self, lines:list[str]) -> None:
+        exact, globs = set(), []
+        for line in lines:
+            line = line.strip()
+            if (len(line) == 0) or line.startswith("#"):
+                continue
+            line = self.normalise(line)
+            if len(line) == 0:
+                continue
+            if any(char in line for char in "*?["):
+                globs.append(fnmatch.translate(line))
+            else:
+                exact.add(line)
+        self.exact = frozenset(exact)
+        if len(globs) == 0:
+            self.pattern = None
+        else:
+            self.pattern = re.compile("|".join(globs))
+
+    def normalise(self, path:str) -> str:
+        # `normcase` lowercases the path on Windows where "SECRET.txt" and
+        # "secret.txt" are the same file
+        path = os.path.normcase(path).replace("\\", "/")
+        path = posixpath.normpath(path).strip("/")
+        return "" if path == "." else path
+
+    def is_ignored(self, path:str) -> bool:
+        # Checks the path and all of the folders that it's in
+        path = self.normalise(path)
+        exact, pattern = self.exact, self.pattern
+        if (len(exact) == 0) and (pattern is None):
+            return False
+        end = 0
+        while end != -1:
+            end = path.find("/", end+1)
+            parent = path if end == -1 else path[:end]
+            if parent in exact:
+                return True
+            if (pattern is not None) and pattern.match(parent):
+                return True
+        return False
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """
+    A thread safe dictionary that forgets the least recently used items
+    when it has more than `max_entries` items or when the sizes passed to
+    `set` add up to more than `max_bytes`.
+    Usage:
+        cache = LRUCache(max_entries=256, max_bytes=1024*1024)
+        cache.set("key", value, size=len(value))
+        cache.get("key") # => value
+        cache.get("other key") # => None
+    """
+    __slots__ = ("data", "lock", "max_entries", "max_bytes", "bytes")
+
+    def __init__(self, max_entries:int=256, max_bytes:int=None):
+        # {key: (value, size)}
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            self.data.move_to_end(key)
+            return self.data[key][0]
+
+    def set(self, key, value, size:int=0) -> None:
+        if (self.max_bytes is not None) and (size > self.max_bytes):
+            # It would evict everything else and still not fit
+            self.pop(key)
+            return None
+        with self.lock:
+            if key in self.data:
+                self.bytes -= self.data.pop(key)[1]
+            self.data[key] = (value, size)
+            self.bytes += size
+            while (len(self.data) > self.max_entries) or \
+                  ((self.max_bytes is not None) and \
+                   (self.bytes > self.max_bytes)):
+                _, (_, old_size) = self.data.popitem(last=False)
+                self.bytes -= old_size
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            value, size = self.data.pop(key)
+            self.bytes -= size
+            return value
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+            self.bytes = 0
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+from threading import Lock
+import mmap
+import os
+
+
+class MmapPool:
+    """
+    Maps each file into memory once and shares the mapping between all of
+    the connections that are sending it. Each `acquire` must be followed by
+    a `release`. Mappings that nobody is using are unmapped when the file
+    changes or when all of the mappings add up to more than `max_bytes`.
+    A mapping of a file that changed while it was being sent is unmapped
+    (and stops counting towards `max_bytes`) by its last `release`.
+    Usage:
+        key, mapping = pool.acquire(file)
+        try:
+            connection.sendall(memoryview(mapping)[start:end])
+        finally:
+            pool.release(key)
+    """
+    __slots__ = ("lock", "mappings", "retired", "files", "max_bytes", "bytes")
+
+    def __init__(self, max_bytes:int):
+        self.lock = Lock()
+        # {(device, inode, mtime, size): [mmap, references]} from least to
+        # most recently used
+        self.mappings = OrderedDict()
+        # The same for the old versions of files that are still being sent
+        self.retired = {}
+        # {(device, inode): (device, inode, mtime, size)}
+        self.files = {}
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    def acquire(self, file) -> tuple[tuple, mmap.mmap]:
+        # Returns `(None, None)` if the file can't be mapped
+        stat = os.fstat(file.fileno())
+        key = (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if (stat.st_size == 0) or (stat.st_size > self.max_bytes):
+            return None, None
+        with self.lock:
+            if key in self.mappings:
+                self.mappings.move_to_end(key)
+                self.mappings[key][1] += 1
+                return key, self.mappings[key][0]
+            if key in self.retired:
+                # The file is back to the version that is still mapped
+                self.mappings[key] = self.retired.pop(key)
+                self.mappings[key][1] += 1
+                self.files[key[:2]] = key
+                return key, self.mappings[key][0]
+
+            # The file changed so the old mapping isn't needed anymore
+            old_key = self.files.get(key[:2], None)
+            if old_key is not None:
+                self.unmap(old_key)
+            self.make_space(stat.st_size)
+            if self.bytes+stat.st_size > self.max_bytes:
+                return None, None
+
+            try:
+                mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return None, None
+            self.mappings[key] = [mapping, 1]
+            self.files[key[:2]] = key
+            self.bytes += stat.st_size
+            return key, mapping
+
+    def release(self, key:tuple) -> None:
+        with self.lock:
+            if key in self.mappings:
+                self.mappings[key][1] -= 1
+            elif key in self.retired:
+                self.retired[key][1] -= 1
+                if self.retired[key][1] == 0:
+                    self.close(self.retired.pop(key)[0])
+
+    def make_space(self, size:int) -> None:
+        # Unmaps the least recently used mappings that nobody is using
+        for key in tuple(self.mappings):
+            if self.bytes+size <= self.max_bytes:
+                break
+            if self.mappings[key][1] == 0:
+                self.unmap(key)
+
+    def unmap(self, key:tuple) -> None:
+        mapping, references = self.mappings.pop(key)
+        if self.files.get(key[:2], None) == key:
+            self.files.pop(key[:2])
+        if references > 0:
+            # Still being sent, it will be unmapped (and its bytes freed) by
+            # the last `release`
+            self.retired[key] = [mapping, references]
+            return None
+        self.close(mapping)
+
+    def close(self, mapping:mmap.mmap) -> None:
+        self.bytes -= len(mapping)
+        try:
+            mapping.close()
+        except BufferError:
+            # A `memoryview` of it still exists somewhere, the mapping is
+            # closed when that is garbage collected
+            pass
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(mappings=len(self.mappings)+len(self.retired),
+                        bytes=self.bytes)
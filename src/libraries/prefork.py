@@ -0,0 +1,175 @@
+from multiprocessing.connection import wait
+from threading import Lock
+from time import monotonic, sleep
+import multiprocessing
+import signal
+import sys
+import os
+
+# A worker that dies sooner than this after starting is probably going to
+# die again, so wait a bit before starting it again
+MIN_UPTIME = 1
+RESTART_DELAY = 1
+
+
+class Worker:
+    __slots__ = ("index", "cpu", "process", "connection", "started", "lock")
+
+    def __init__(self, index:int, cpu:int):
+        self.index = index
+        self.cpu = cpu
+        self.process = None
+        self.connection = None
+        self.started = None
+        self.lock = Lock()
+
+
+class Supervisor:
+    """
+    Runs `target(index, connection, *args)` in `workers` processes and
+    starts the ones that die again. `connection` is one end of a `Pipe`,
+    the worker should send "ready" once it's ready to work, answer "stats"
+    with a dictionary and stop when it gets "stop" (or when the pipe
+    closes). If `affinity` is `True`, each
+    worker is pinned to its own CPU (where the platform supports it).
+    Usage:
+        supervisor = Supervisor(run_worker, workers=4, args=(80, ))
+        supervisor.start()
+        supervisor.wait_ready()
+        supervisor.run() # Until `supervisor.stop()` is called
+    """
+    __slots__ = ("target", "workers", "args", "running", "restarts")
+
+    def __init__(self, target, workers:int, args:tuple=(),
+                 affinity:bool=False):
+        if workers < 1:
+            raise ValueError("A Supervisor needs at least 1 worker.")
+        self.target = target
+        self.args = args
+        self.running = False
+        self.restarts = 0
+        cpus = get_cpus() if affinity else []
+        self.workers = [Worker(i, cpus[i%len(cpus)] if cpus else None)
+                        for i in range(workers)]
+
+    def start(self) -> None:
+        self.running = True
+        for worker in self.workers:
+            self.start_worker(worker)
+
+    def start_worker(self, worker:Worker) -> None:
+        connection, child_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=worker_main, daemon=True,
+                                          args=(self.target, worker.index,
+                                                worker.cpu, child_connection,
+                                                self.args))
+        process.start()
+        child_connection.close()
+        with worker.lock:
+            worker.process = process
+            worker.connection = connection
+            worker.started = monotonic()
+
+    def run(self) -> None:
+        # Waits for workers to die and starts them again
+        while self.running:
+            sentinels = [worker.process.sentinel for worker in self.workers]
+            wait(sentinels, timeout=0.5)
+            for worker in self.workers:
+                if (not self.running) or worker.process.is_alive():
+                    continue
+                sys.stderr.write(f"[Debug]: Worker {worker.index} died "
+                                 f"({worker.process.exitcode}), restarting.\n")
+                if monotonic()-worker.started < MIN_UPTIME:
+                    sleep(RESTART_DELAY)
+                worker.connection.close()
+                self.restarts += 1
+                self.start_worker(worker)
+
+    def send(self, worker:Worker, command:str, timeout:float=1) -> object:
+        # Returns the worker's answer or `None` if it didn't answer in time
+        with worker.lock:
+            try:
+                worker.connection.send(command)
+                if command in ("stop", "drain"):
+                    return None
+                while worker.connection.poll(timeout):
+                    answer = worker.connection.recv()
+                    # Left over from a worker that `wait_ready` didn't wait for
+                    if answer != "ready":
+                        return answer
+            except (EOFError, OSError):
+                pass
+            return None
+
+    def wait_ready(self, timeout:float=10) -> bool:
+        # Waits for all of the workers to send "ready". Returns `False` if
+        # some of them didn't in time.
+        deadline = monotonic() + timeout
+        ready = True
+        for worker in self.workers:
+            with worker.lock:
+                try:
+                    if worker.connection.poll(max(deadline-monotonic(), 0)):
+                        ready &= worker.connection.recv() == "ready"
+                        continue
+                except (EOFError, OSError):
+                    pass
+                ready = False
+        return ready
+
+    def get_stats(self) -> dict[str, dict[str, int]]:
+        answers = [self.send(worker, "stats") for worker in self.workers]
+        answers = [answer for answer in answers if answer is not None]
+        stats = combine_stats(answers)
+        stats["workers"] = dict(workers=len(self.workers),
+                                answered=len(answers),
+                                restarts=self.restarts)
+        return stats
+
+    def stop(self, timeout:float=5, command:str="stop") -> None:
+        # `command` can also be "drain" (let the workers finish sending the
+        # responses first). Workers still alive after `timeout` are killed.
+        self.running = False
+        for worker in self.workers:
+            self.send(worker, command)
+        deadline = monotonic() + timeout
+        for worker in self.workers:
+            worker.process.join(max(deadline-monotonic(), 0))
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.connection.close()
+
+
+def worker_main(target, index:int, cpu:int, connection, args:tuple) -> None:
+    # Ctrl-C goes to all of the processes, only the supervisor handles it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The supervisor's other signal handlers shouldn't run in the workers
+    for name in ("SIGTERM", "SIGUSR2"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), signal.SIG_DFL)
+    # The supervisor collects the stats from the workers
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    if (cpu is not None) and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {cpu})
+    target(index, connection, *args)
+
+
+def get_cpus() -> list[int]:
+    # The CPUs that this process is allowed to run on
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return []
+
+
+def combine_stats(stats:list[dict]) -> dict:
+    # Adds up the numbers in the workers' (nested) stats dictionaries
+    combined = {}
+    for item in stats:
+        for key, value in item.items():
+            if isinstance(value, dict):
+                combined[key] = combine_stats([combined.get(key, {}), value])
+            elif isinstance(value, (int, float)):
+                combined[key] = combined.get(key, 0) + value
+    return combined
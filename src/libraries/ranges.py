@@ -0,0 +1,52 @@
+MAX_RANGES = 16
+
+
+def parse_range(header:str, size:int) -> list[tuple[int, int]]:
+    """
+    Parses the value of a "Range" header for a file with `size` bytes.
+    Returns:
+        None                    if the whole file should be sent (no header,
+                                    a header we don't understand or too
+                                    many ranges)
+        []                      if none of the ranges are in the file (416)
+        [(start, end), ...]     the (inclusive) byte ranges to send. Ranges
+                                    that overlap or touch are merged.
+    """
+    if header is None:
+        return None
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+
+    ranges = []
+    for spec in specs.split(","):
+        start, dash, end = spec.strip().partition("-")
+        if (not dash) or (not (start+end).isdigit()):
+            return None
+        # "-500" means the last 500 bytes
+        if start == "":
+            length = int(end)
+            if (length == 0) or (size == 0):
+                continue
+            ranges.append((max(size-length, 0), size-1))
+            continue
+        start = int(start)
+        # "500-" means everything from byte 500
+        if end == "":
+            end = size-1
+        elif int(end) < start:
+            return None
+        end = min(int(end), size-1)
+        if start < size:
+            ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and (start <= merged[-1][1]+1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
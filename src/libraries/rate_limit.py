@@ -0,0 +1,160 @@
+from threading import Lock
+from time import monotonic
+import socket
+import sys
+
+# Python's `socket` doesn't have it but linux does (since linux 3.13)
+if hasattr(socket, "SO_MAX_PACING_RATE"):
+    SO_MAX_PACING_RATE = socket.SO_MAX_PACING_RATE
+elif sys.platform.startswith("linux"):
+    SO_MAX_PACING_RATE = 47
+else:
+    SO_MAX_PACING_RATE = None
+
+
+class TokenBucket:
+    """
+    Lets through `rate` bytes per second on average and at most `burst`
+    bytes at once.
+    Usage:
+        bucket = TokenBucket(rate=1024*1024)
+        sleep(bucket.reserve(len(data)))
+        connection.sendall(data)
+    """
+    __slots__ = ("rate", "burst", "tokens", "last", "lock")
+
+    def __init__(self, rate:int, burst:int=None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self.last = monotonic()
+        self.lock = Lock()
+
+    def reserve(self, amount:int) -> float:
+        # Takes `amount` tokens and returns how many seconds to wait before
+        # using them (the bucket can go into debt)
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now-self.last)*self.rate)
+            self.last = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens/self.rate
+
+
+class Pacer:
+    """
+    The buckets that the data sent on one connection has to go through. It
+    also measures how fast the client is reading the data.
+    """
+    __slots__ = ("buckets", "ip", "kernel", "sent", "send_time")
+
+    def __init__(self, buckets:list[TokenBucket], ip:str, kernel:bool):
+        self.buckets = buckets
+        self.ip = ip
+        # If the kernel limits the connection's rate
+        self.kernel = kernel
+        # The bytes sent and the seconds spent sending them (without the
+        # time spent waiting for the buckets)
+        self.sent = 0
+        self.send_time = 0
+
+    @property
+    def limited(self) -> bool:
+        return len(self.buckets) > 0
+
+    def delay(self, amount:int) -> float:
+        # How long to wait before sending `amount` more bytes
+        return max((bucket.reserve(amount) for bucket in self.buckets),
+                   default=0)
+
+    def record(self, amount:int, seconds:float) -> None:
+        self.sent += amount
+        self.send_time += seconds
+
+    def too_slow(self, min_rate:float, grace:float) -> bool:
+        # If the client reads slower than `min_rate` bytes per second (only
+        # after `grace` seconds, the first few sends fill the socket's buffer)
+        return (self.send_time >= grace) and \
+               (self.sent < min_rate*self.send_time)
+
+
+class RateLimiter:
+    """
+    Bandwidth limits (in bytes per second, `None` means unlimited) for each
+    connection, each IP address and for all connections together. The limit
+    for each connection is left to the kernel (`SO_MAX_PACING_RATE`) when it
+    supports it.
+    Usage:
+        limiter = RateLimiter(per_connection=1024*1024*8)
+        pacer = limiter.open(connection)
+        try:
+            sleep(pacer.delay(len(data)))
+            connection.sendall(data)
+        finally:
+            limiter.close(pacer)
+    """
+    __slots__ = ("per_connection", "per_ip", "total", "bucket", "ips",
+                 "lock", "kernel_paced")
+
+    def __init__(self, per_connection:int=None, per_ip:int=None,
+                 total:int=None):
+        self.per_connection = per_connection
+        self.per_ip = per_ip
+        self.total = total
+        self.bucket = None if total is None else TokenBucket(total)
+        # {ip: [bucket, connections]}
+        self.ips = {}
+        self.lock = Lock()
+        self.kernel_paced = 0
+
+    def open(self, connection:socket.socket) -> Pacer:
+        buckets = []
+        if self.bucket is not None:
+            buckets.append(self.bucket)
+
+        kernel = False
+        if self.per_connection is not None:
+            kernel = self.set_pacing_rate(connection, self.per_connection)
+            if not kernel:
+                buckets.append(TokenBucket(self.per_connection))
+
+        try:
+            ip = connection.getpeername()[0]
+        except (OSError, IndexError):
+            ip = None
+        if (self.per_ip is not None) and (ip is not None):
+            with self.lock:
+                if ip not in self.ips:
+                    self.ips[ip] = [TokenBucket(self.per_ip), 0]
+                self.ips[ip][1] += 1
+                buckets.append(self.ips[ip][0])
+        else:
+            ip = None
+        return Pacer(buckets, ip, kernel)
+
+    def close(self, pacer:Pacer) -> None:
+        if pacer.ip is None:
+            return None
+        with self.lock:
+            self.ips[pacer.ip][1] -= 1
+            if self.ips[pacer.ip][1] == 0:
+                del self.ips[pacer.ip]
+
+    def set_pacing_rate(self, connection:socket.socket, rate:int) -> bool:
+        # Returns `True` if the kernel will limit the connection's rate
+        if SO_MAX_PACING_RATE is None:
+            return False
+        try:
+            connection.setsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE, rate)
+        except (OSError, OverflowError):
+            return False
+        with self.lock:
+            self.kernel_paced += 1
+        return True
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(ips=len(self.ips), kernel_paced=self.kernel_paced)
@@ -1,16 +1,20 @@
+from time import strftime, localtime
+from email.utils import formatdate
+from typing import Iterator
 import sys
+import os
+
+from libraries import content_encoding
 
 
 # Connection: close
 HTTP_HEADER = """
-HTTP/1.1 200 OK
-Content-Type: {mimetype}; utf-8
-Accept-Ranges: bytes
-Content-Length: {file_length}
-Connection: keep-alive
-Cache-Control: no-cache
+HTTP/1.1 {status}
+{content_type}Accept-Ranges: bytes
+{content_length}Connection: keep-alive
+Cache-Control: {cache_control}
 X-Content-Type-Options: nosniff
-
+{headers}
 """[1:].replace("\n", "\r\n")
 
 
@@ -67,15 +71,54 @@ EXTENSION_MIMETYPE = {
 EXTENSION_MIMETYPE["ts"] = EXTENSION_MIMETYPE["*"]
 
 
+# How long browsers can use their copy of a file without asking us if it
+# changed. "no-cache" means they always ask (we can answer "304 Not Modified")
+CACHE_CONTROL = {
+                 # Videos/Audio
+                 "mp4":  "public, max-age=604800",
+                 "ts":   "public, max-age=604800",
+                 "avi":  "public, max-age=604800",
+                 "mpeg": "public, max-age=604800",
+                 "mp3":  "public, max-age=604800",
+                 "wav":  "public, max-age=604800",
+                 # Images:
+                 "ico":  "public, max-age=86400",
+                 "png":  "public, max-age=86400",
+                 "svg":  "public, max-age=86400",
+                 "gif":  "public, max-age=86400",
+                 "jpg":  "public, max-age=86400",
+                 "jpeg": "public, max-age=86400",
+                 "bmp":  "public, max-age=86400",
+                 # Fonts:
+                 "ttf":  "public, max-age=604800",
+                 "otf":  "public, max-age=604800",
+                 # Text:
+                 "css":  "public, max-age=3600",
+                 "js":   "public, max-age=3600",
+                 "mjs":  "public, max-age=3600",
+                 # Default:
+                 "*":    "no-cache"
+                }
+
+
 class HTTPResponse:
-    __slots__ = ("data", "mimetype", "file_length")
-    def __init__(self, file_length:int=None, mimetype:str=None, data:bytes=b""):
+    __slots__ = ("data", "mimetype", "file_length", "status", "headers",
+                 "encoding")
+    def __init__(self, file_length:int=None, mimetype:str=None, data:bytes=b"",
+                 status:str="200 OK", headers:dict=None, encoding:str=None):
         if mimetype is None:
             mimetype = EXTENSION_MIMETYPE["*"]
+        if headers is None:
+            headers = {}
 
         self.mimetype = mimetype
         self.data = data
         self.file_length = file_length
+        self.status = status
+        # Any extra headers
+        self.headers = headers
+        # The "Content-Encoding" of the body (`data` is compressed in `to_bytes`)
+        self.encoding = encoding
 
     def mimetype_from_extension(self, extension:str) -> None:
         if extension in EXTENSION_MIMETYPE:
@@ -86,14 +129,37 @@ class HTTPResponse:
 
     def to_bytes(self) -> bytes:
         body = self.get_body()
+        if self.encoding is not None:
+            body = content_encoding.compress(body, self.encoding)
         return self.get_header(file_length=len(body)) + body
     __bytes__ = to_bytes
 
     def get_header(self, file_length:int) -> bytes:
+        # A `file_length` of `None` means that the body is sent in chunks
         if self.file_length is not None:
             file_length = self.file_length
-        return HTTP_HEADER.format(mimetype=self.mimetype,
-                                  file_length=file_length).encode()
+        content_type = f"Content-Type: {self.mimetype}; utf-8\r\n"
+        if ";" in self.mimetype:
+            # It already has its parameters ("multipart/byteranges; boundary=")
+            content_type = f"Content-Type: {self.mimetype}\r\n"
+        if self.status.startswith("304"):
+            # Doesn't have a body (and the cached one keeps its type)
+            content_type = content_length = ""
+        elif file_length is None:
+            content_length = "Transfer-Encoding: chunked\r\n"
+        else:
+            content_length = f"Content-Length: {file_length}\r\n"
+        headers = dict(self.headers)
+        cache_control = headers.pop("Cache-Control", "no-cache")
+        if self.encoding is not None:
+            headers["Content-Encoding"] = self.encoding
+            headers["Vary"] = "Accept-Encoding"
+        headers = "".join(f"{name}: {value}\r\n"
+                          for name, value in headers.items())
+        return HTTP_HEADER.format(status=self.status, content_type=content_type,
+                                  content_length=content_length,
+                                  cache_control=cache_control,
+                                  headers=headers).encode()
 
     def get_body(self) -> bytes:
         return self.data
@@ -152,25 +218,15 @@ class HTMLCode:
     def to_bytes(self, **kwargs) -> bytes:
         return self.to_string(**kwargs).encode()
 
-    def to_http(self, **kwargs) -> bytes:
+    def to_http(self, encoding:str=None, headers:dict=None, **kwargs) -> bytes:
         data = self.to_bytes(**kwargs)
-        response = HTTPResponse(data=data)
+        response = HTTPResponse(data=data, encoding=encoding, headers=headers)
         response.set_extension("html")
         return response.to_bytes()
 
     def construct_website(self, **kwargs) -> str:
         if self.website == "folder":
-            full_text = HTML_FOLDER
-            # The start of the HTML
-            text = full_text[0]
-            # The files listed
-            for file in kwargs["files"]:
-                text += "\n        "
-                text += f"<a href=\"\"/ onclick=\"return goto('{file}')\">" \
-                        f"{file}</a><p></p>"
-            # The end of the HTML
-            text += full_text[1]
-            return text.format(**JSCode(3).format(**kwargs), **kwargs)
+            return "".join(folder_parts(kwargs["files"]))
 
         if self.website == "404":
             return HTML_404.format(**JSCode(2).format(**kwargs), **kwargs)
@@ -185,12 +241,26 @@ class HTMLCode:
         if self.website == "play mp4":
             return HTML_MP4.format(**JSCode(2).format(**kwargs), **kwargs)
 
-        if self.website == "raw":
-            return kwargs["html"]
-
         raise RuntimeError("Unknown type of website.")
 
 
+def folder_parts(files:((str, int, float), ...)) -> Iterator[str]:
+    # Yields the folder's HTML a bit at a time so we never need all of it
+    # in one string
+    js = JSCode(3).format()
+    # The start of the HTML
+    yield HTML_FOLDER[0].format(**js)
+    # The files listed
+    for file, size, mtime in files:
+        file = file.replace("\\", "/")
+        size = "folder" if size is None else format_size(size)
+        mtime = strftime("%Y-%m-%d %H:%M", localtime(mtime))
+        yield f"\n        <a href=\"\"/ onclick=\"return goto('{file}')\">" \
+              f"{file}</a> <small>{size}, {mtime}</small><p></p>"
+    # The end of the HTML
+    yield HTML_FOLDER[1]
+
+
 # All of the JS code:
 GOTO_JS = """
 function goto(filename){{
@@ -319,30 +389,42 @@ HTML_MP4 = """
 """[1:]
 
 
-def response_from_mp2t(data:bytes, length:int=None) -> bytes:
-    if length is None:
-        length = len(data)
-    response = HTTPResponse(file_length=length, data=data)
-    response.set_extension("ts")
-    return response.to_bytes()
-
-def response_from_mp4(data:bytes, length:int=None) -> bytes:
-    if length is None:
-        length = len(data)
-    response = HTTPResponse(file_length=length, data=data)
-    response.set_extension("mp4")
+def partial_content(extension:str, start:int, end:int, size:int,
+                    headers:dict=None) -> bytes:
+    headers = dict(headers or {})
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response = HTTPResponse(file_length=end-start+1, status="206 Partial Content",
+                            headers=headers)
+    response.set_extension(extension)
     return response.to_bytes()
 
-def txt(text:bytes, length:int=None) -> bytes:
-    if length is None:
-        length = len(data)
-    response = HTTPResponse(file_length=length, data=text)
-    response.set_extension("txt")
+def multipart_byteranges(extension:str, ranges:list[tuple[int, int]],
+                         size:int,
+                         headers:dict=None) -> tuple[bytes, tuple[bytes, ...]]:
+    # Returns the headers and the text that goes before each range. The last
+    # item in the tuple goes after the last range.
+    boundary = os.urandom(12).hex()
+    mimetype = EXTENSION_MIMETYPE.get(extension, EXTENSION_MIMETYPE["*"])
+
+    parts = []
+    for start, end in ranges:
+        parts.append(f"\r\n--{boundary}\r\n"
+                     f"Content-Type: {mimetype}\r\n"
+                     f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n".encode())
+    parts.append(f"\r\n--{boundary}--\r\n".encode())
+
+    length = sum(map(len, parts)) + sum(end-start+1 for start, end in ranges)
+    response = HTTPResponse(file_length=length, status="206 Partial Content",
+                            headers=headers)
+    response.mimetype = f"multipart/byteranges; boundary={boundary}"
+    return response.to_bytes(), tuple(parts)
+
+def range_not_satisfiable(size:int) -> bytes:
+    headers = {"Content-Range": f"bytes */{size}"}
+    response = HTTPResponse(file_length=0, status="416 Range Not Satisfiable",
+                            headers=headers)
     return response.to_bytes()
 
-def raw_html(html:str) -> bytes:
-    return HTMLCode("raw").to_http(html=html)
-
 def get_404(filename:str) -> bytes:
     filename = filename.replace("\\", "/").split("/")[-1]
     return HTMLCode("404").to_http(filename=filename)
@@ -356,9 +438,100 @@ def get_favicon() -> bytes:
     response.set_extension("ico")
     return response.to_bytes().replace(b"200 OK", b"404 Not Found")
 
-def folder(files:(str, ...)) -> bytes:
-    files = tuple(file.replace("\\", "/") for file in files)
-    return HTMLCode("folder").to_http(files=files)
+def format_size(size:int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "TB"
+    if unit == "B":
+        return f"{size} B"
+    return f"{size:.1f} {unit}"
+
+def folder(files:((str, int, float), ...), encoding:str=None,
+           headers:dict=None) -> bytes:
+    # `files` has `(filename, size, mtime)` for each file. The size of
+    # folders should be `None`.
+    return HTMLCode("folder").to_http(files=files, encoding=encoding,
+                                      headers=headers)
+
+def folder_chunked(files:((str, int, float), ...), encoding:str=None,
+                   headers:dict=None,
+                   chunk_size:int=1024*64) -> Iterator[bytes]:
+    # Like `folder` but yields the headers and then the HTML using
+    # "Transfer-Encoding: chunked" so it can start sending straight away
+    return chunked("html", (part.encode() for part in folder_parts(files)),
+                   encoding=encoding, headers=headers, chunk_size=chunk_size)
+
+def chunked(extension:str, parts:Iterator[bytes], encoding:str=None,
+            headers:dict=None, chunk_size:int=1024*64) -> Iterator[bytes]:
+    # Yields the headers and then `parts` using "Transfer-Encoding: chunked"
+    # (compressing them on the way if `encoding` isn't `None`). Compressed
+    # parts are used up straight away so they can share a reused buffer.
+    response = HTTPResponse(encoding=encoding, headers=headers)
+    response.set_extension(extension)
+    yield response.get_header(file_length=None)
+    compressor = None
+    if encoding is not None:
+        compressor = content_encoding.Compressor(encoding)
+
+    chunk, length = [], 0
+    for part in parts:
+        length += len(part)
+        if compressor is not None:
+            part = compressor.compress(part)
+        chunk.append(part)
+        if length >= chunk_size:
+            yield encode_chunk(b"".join(chunk), compressor)
+            chunk, length = [], 0
+    yield encode_chunk(b"".join(chunk), compressor)
+    if compressor is not None:
+        yield encode_chunk(compressor.finish())
+    yield b"0\r\n\r\n"
+
+def encode_chunk(data:bytes, compressor:content_encoding.Compressor=None) -> bytes:
+    # `data` has already been compressed, `compressor` only has to flush
+    if compressor is not None:
+        data += compressor.flush()
+    # An empty chunk would end the body
+    if len(data) == 0:
+        return b""
+    return f"{len(data):X}\r\n".encode() + data + b"\r\n"
+
+def file_header(extension:str, length:int, encoding:str=None,
+                headers:dict=None) -> bytes:
+    # The headers for a file with `length` bytes (after it's been compressed)
+    response = HTTPResponse(file_length=length, encoding=encoding,
+                            headers=headers)
+    response.set_extension(extension)
+    return response.get_header(file_length=length)
+
+def not_modified(headers:dict=None) -> bytes:
+    return HTTPResponse(status="304 Not Modified", headers=headers).to_bytes()
+
+def validators(etag:str, last_modified:float=None, cache_control:str=None,
+               vary:bool=False) -> dict:
+    # The headers that let the browser ask if the file changed. `vary` means
+    # that there are compressed versions of the response.
+    headers = {"ETag": etag}
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+    if cache_control is not None:
+        headers["Cache-Control"] = cache_control
+    if vary:
+        headers["Vary"] = "Accept-Encoding"
+    return headers
+
+def cache_control(extension:str) -> str:
+    return CACHE_CONTROL.get(extension.lower(), CACHE_CONTROL["*"])
+
+def head_only(response:bytes) -> bytes:
+    # Removes the body (for HEAD requests)
+    end = response.find(b"\r\n\r\n")
+    if end == -1:
+        return response
+    return response[:end+4]
 
 def error(error:Exception, traceback:str) -> bytes:
     error = repr(error).replace("'", "\"")\
@@ -372,6 +545,22 @@ def error(error:Exception, traceback:str) -> bytes:
 
     return HTMLCode("error").to_http(error=error, traceback=traceback)
 
+def bad_request(status:str) -> bytes:
+    headers = {}
+    if status.startswith("405"):
+        headers["Allow"] = "GET, HEAD"
+    response = HTTPResponse(file_length=0, status=status, headers=headers)
+    return close_connection(response.to_bytes())
+
+def try_again_later(status:str, retry_after:int) -> bytes:
+    # Sent instead of handling a connection when the server is too busy
+    response = HTTPResponse(file_length=0, status=status,
+                            headers={"Retry-After": str(retry_after)})
+    return close_connection(response.to_bytes())
+
+def close_connection(response:bytes) -> bytes:
+    return response.replace(b"Connection: keep-alive", b"Connection: close", 1)
+
 def play_mp4_file(filename:str) -> bytes:
     filename = filename.replace("\\", "/").split("/")[-1]
     return HTMLCode("play mp4").to_http(filename=filename)
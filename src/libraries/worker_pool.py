@@ -0,0 +1,68 @@
+from threading import Thread, stack_size
+from queue import Queue, Full
+import traceback
+
+
+class WorkerPool:
+    """
+    A fixed number of threads that are reused to call `function` with the
+    arguments passed to `put`. The arguments wait in a bounded queue so
+    `put` blocks while all of the workers are busy and the queue is full.
+    Usage:
+        pool = WorkerPool(handle_connection, threads=32, queue_size=64)
+        pool.start()
+        while True:
+            connection, address = sock.accept()
+            pool.put(connection)
+
+    `thread_stack_size` is passed to `threading.stack_size` (0 means the
+    platform default) so a lot of idle workers don't reserve 8MB each.
+    """
+    __slots__ = ("function", "queue", "threads", "nthreads", "running",
+                 "thread_stack_size")
+
+    def __init__(self, function, threads:int=32, queue_size:int=64,
+                 thread_stack_size:int=0):
+        if threads < 1:
+            raise ValueError("A WorkerPool needs at least 1 thread.")
+        self.function = function
+        self.queue = Queue(maxsize=queue_size)
+        self.thread_stack_size = thread_stack_size
+        self.nthreads = threads
+        self.running = False
+        self.threads = []
+
+    def start(self) -> None:
+        self.running = True
+        old_stack_size = stack_size(self.thread_stack_size)
+        try:
+            for i in range(self.nthreads):
+                thread = Thread(target=self.worker, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+        finally:
+            stack_size(old_stack_size)
+
+    def put(self, *args) -> None:
+        self.queue.put(args)
+
+    def stop(self) -> None:
+        self.running = False
+        # Wake up the idle workers. If the queue is full, the workers will
+        # see `self.running` after they finish their current job.
+        for thread in self.threads:
+            try:
+                self.queue.put_nowait(None)
+            except Full:
+                break
+        self.threads.clear()
+
+    def worker(self) -> None:
+        while self.running:
+            args = self.queue.get()
+            if args is None:
+                break
+            try:
+                self.function(*args)
+            except Exception:
+                traceback.print_exc()
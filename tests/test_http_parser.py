@@ -0,0 +1,43 @@
+import unittest
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from libraries.http_parser import RequestParser, BadRequest
+
+
+def parse(target:bytes):
+    parser = RequestParser()
+    parser.feed(b"GET " + target + b" HTTP/1.1\r\n\r\n")
+    return parser.next_request()
+
+
+class TestRequestPath(unittest.TestCase):
+    def test_decodes_path(self) -> None:
+        self.assertEqual(parse(b"/a%20b.mp4?t=1").path, "a b.mp4")
+        self.assertEqual(parse(b"/").path, "")
+        self.assertEqual(parse(b"/sub/a..b").path, "sub/a..b")
+
+    def test_double_slash_is_rejected(self) -> None:
+        with self.assertRaises(BadRequest):
+            parse(b"//etc/hostname").path
+
+    def test_encoded_slash_is_rejected(self) -> None:
+        for target in (b"/%2Fetc/hostname", b"/%2fetc/hostname",
+                       b"/%5Cetc%5Chostname"):
+            with self.assertRaises(BadRequest):
+                parse(target).path
+
+    def test_parent_folder_is_rejected(self) -> None:
+        for target in (b"/../x", b"/a/../../x", b"/%2e%2e/x", b"/a%5C..%5Cx"):
+            with self.assertRaises(BadRequest):
+                parse(target).path
+
+    def test_drive_is_rejected(self) -> None:
+        with self.assertRaises(BadRequest):
+            parse(b"/C:/Windows/win.ini").path
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+from unittest import mock
+from time import sleep, monotonic
+import urllib.request
+import tempfile
+import unittest
+import os.path
+import socket
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import hoster
+
+
+FILE_SIZE = 1024*1024*32
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestMinSendRate(unittest.TestCase):
+    def setUp(self) -> None:
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        with open(os.path.join(folder.name, "big.bin"), "wb") as file:
+            file.write(os.urandom(FILE_SIZE))
+        cwd = os.getcwd()
+        os.chdir(folder.name)
+        self.addCleanup(os.chdir, cwd)
+        for name, value in (("MIN_SEND_RATE", 1024*1024*4),
+                            ("MIN_RATE_GRACE", 0.2), ("SEND_TIMEOUT", 30)):
+            patcher = mock.patch.object(hoster, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def start(self, engine:str) -> tuple[hoster.FTPServer, int]:
+        port = free_port()
+        with mock.patch.object(sys, "stdout"), mock.patch.object(sys, "stderr"):
+            server = hoster.FTPServer(port, engine=engine)
+            server.start_server()
+        self.addCleanup(server.stop)
+        return server, port
+
+    def too_slow(self, server:hoster.FTPServer) -> int:
+        deadline = monotonic() + 2
+        while (server.connection_stats()["too_slow"] == 0) and \
+              (monotonic() < deadline):
+            sleep(0.05)
+        return server.connection_stats()["too_slow"]
+
+    def test_slow_reader_is_dropped(self) -> None:
+        for engine in hoster.ENGINES:
+            with self.subTest(engine=engine):
+                server, port = self.start(engine)
+                client = socket.create_connection(("127.0.0.1", port))
+                client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+                client.sendall(b"GET /big.bin HTTP/1.1\r\n\r\n")
+                # About 400KB/s, far below `MIN_SEND_RATE`
+                received, start = 0, monotonic()
+                try:
+                    while monotonic()-start < 20:
+                        data = client.recv(4096)
+                        if len(data) == 0:
+                            break
+                        received += len(data)
+                        sleep(0.01)
+                except ConnectionResetError:
+                    pass
+                client.close()
+                self.assertLess(monotonic()-start, 20)
+                self.assertLess(received, FILE_SIZE)
+                self.assertEqual(self.too_slow(server), 1)
+                self.assertEqual(server.connection_stats()["send_timeouts"],
+                                 0)
+
+    def test_fast_reader_is_not_dropped(self) -> None:
+        for engine in hoster.ENGINES:
+            with self.subTest(engine=engine):
+                server, port = self.start(engine)
+                url = f"http://127.0.0.1:{port}/big.bin"
+                with urllib.request.urlopen(url, timeout=20) as response:
+                    self.assertEqual(len(response.read()), FILE_SIZE)
+                self.assertEqual(server.connection_stats()["too_slow"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
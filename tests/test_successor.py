@@ -0,0 +1,68 @@
+from unittest import mock
+import unittest
+import os.path
+import signal
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import hoster
+
+
+READY = "import os; os.write(int(os.environ['HOSTER_READY_FD']), b'\\x00')"
+
+
+class TestStartSuccessor(unittest.TestCase):
+    def start(self, code:str, timeout:float=10):
+        # Runs `code` as the successor and returns (`start_successor`'s
+        # result, the process that it started)
+        processes = []
+        class Popen(hoster.subprocess.Popen):
+            def __init__(self, *args, **kwargs) -> None:
+                super().__init__(*args, **kwargs)
+                processes.append(self)
+        with mock.patch.object(sys, "argv", ["-c", code]), \
+             mock.patch.object(hoster.subprocess, "Popen", Popen), \
+             mock.patch.object(sys, "stderr"):
+            result = hoster.start_successor(timeout=timeout)
+        self.addCleanup(processes[0].wait)
+        return result, processes[0]
+
+    def test_ready(self) -> None:
+        result, process = self.start(READY)
+        self.assertIs(result, process)
+
+    def test_exits_immediately(self) -> None:
+        result, process = self.start("import sys; sys.exit(1)")
+        self.assertIsNone(result)
+        # Reaped
+        self.assertEqual(process.returncode, 1)
+
+    def test_not_ready_in_time(self) -> None:
+        result, process = self.start("import time; time.sleep(30)",
+                                     timeout=0.2)
+        self.assertIsNone(result)
+        # Killed and reaped
+        self.assertIsNotNone(process.returncode)
+
+
+@unittest.skipUnless(hasattr(signal, "SIGUSR2"), "needs SIGUSR2")
+class TestShouldDrain(unittest.TestCase):
+    def test_failed_successor_keeps_serving(self) -> None:
+        signals = [signal.SIGUSR2]
+        with mock.patch.object(hoster, "start_successor", return_value=None):
+            self.assertFalse(hoster.should_drain(signals))
+        self.assertEqual(signals, [])
+
+    def test_started_successor_drains(self) -> None:
+        with mock.patch.object(hoster, "start_successor", return_value=True):
+            self.assertTrue(hoster.should_drain([signal.SIGUSR2]))
+
+    def test_sigterm_drains(self) -> None:
+        with mock.patch.object(hoster, "start_successor") as start_successor:
+            self.assertTrue(hoster.should_drain([signal.SIGTERM]))
+        start_successor.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()